@@ -21,6 +21,14 @@ W_WIDTH = 800
 W_HEIGHT = 600
 GUI_HEIGHT = 100
 
+# the physics constants (speed, friction, forces) are tuned per frame at
+# this rate; the simulation always advances in fixed steps of this length
+PHYSICS_FPS = 60
+TIMESTEP = 1 / PHYSICS_FPS
+# if rendering falls behind, run at most this many physics steps per frame
+# and drop the rest of the backlog (avoids the "spiral of death")
+MAX_SUBSTEPS = 5
+
 
 # ------------- helper functions ----------------------------------------------
 
@@ -54,7 +62,10 @@ class Game:
         self.screen = pg.display.set_mode((W_WIDTH, W_HEIGHT))
         self.screen_rect = self.screen.get_rect()
         self.screen_rect.h -= GUI_HEIGHT          
-        self.fps = 60       
+        # render rate, independent of the physics rate (e.g. 30 to save CPU)
+        self.fps = 60
+        # unsimulated time carried over between frames (in seconds)
+        self.accumulator = 0
         self.all_sprites = pg.sprite.Group()
         self.gui_elements = pg.sprite.Group()
         self.font = pg.font.SysFont('Arial', 18)
@@ -77,9 +88,9 @@ class Game:
                 self.running = False
 
     
-    def update(self):
-        self.all_sprites.update()
-        self.gui_elements.update()
+    def update(self, dt):
+        # advance the simulation by one fixed step of dt seconds
+        self.all_sprites.update(dt)
 
     
     def draw(self):
@@ -96,10 +107,21 @@ class Game:
     def run(self):
         self.running = True
         while self.running:
-            self.clock.tick(self.fps)
-            self.events()        
-            self.update()
-            self.draw()
+            self.accumulator += self.clock.tick(self.fps) / 1000
+            self.events()
+            self.gui_elements.update()
+            # consume the elapsed time in fixed physics steps
+            steps = 0
+            while self.accumulator >= TIMESTEP and steps < MAX_SUBSTEPS:
+                self.update(TIMESTEP)
+                self.accumulator -= TIMESTEP
+                steps += 1
+            if steps == MAX_SUBSTEPS:
+                # too far behind, drop the remaining backlog
+                self.accumulator = min(self.accumulator, TIMESTEP)
+            # nothing moved if no step ran, so the render can be skipped
+            if steps > 0:
+                self.draw()
         
         pg.quit()
 
@@ -121,13 +143,16 @@ class Physics_object(pg.sprite.Sprite):
         self.friction = 0.9
         
     
-    def update(self):       
-        self.vel += self.acc
-        self.pos += self.vel * self.speed
+    def update(self, dt):
+        # dt in seconds, converted to frames at PHYSICS_FPS because speed,
+        # friction and the steering forces are tuned per frame
+        frames = dt * PHYSICS_FPS
+        self.vel += self.acc * frames
+        self.pos += self.vel * self.speed * frames
         # reset acceleration
         self.acc *= 0
-        # apply friction
-        self.vel *= self.friction   
+        # apply friction (exponential decay, so it doesn't depend on dt)
+        self.vel *= self.friction ** frames
                         
         # wrap around the edges of the screen
         if self.pos.x > self.game.screen_rect.w:
@@ -152,14 +177,14 @@ class Player(Physics_object):
         self.speed = 0.5
         
     
-    def update(self):
+    def update(self, dt):
         # steer player with WASD
         keys = pg.key.get_pressed() 
         self.acc.x = keys[pg.K_d] - keys[pg.K_a]
         self.acc.y = keys[pg.K_s] - keys[pg.K_w]
         # normalize the acceleration vector
         limit(self.acc, 1)      
-        super().update()
+        super().update(dt)
         
 
 
@@ -178,7 +203,7 @@ class Boid(Physics_object):
         self.theta = 0
 
     
-    def update(self):
+    def update(self, dt):
         # seek a target
         self.acc += self.wander()
         
@@ -194,7 +219,7 @@ class Boid(Physics_object):
         self.acc += alignment     
         self.acc += separation
         self.acc += cohesion 
-        super().update()
+        super().update(dt)
 
 
     def alignment(self):
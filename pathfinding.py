@@ -1,7 +1,15 @@
 import pygame as pg
+import numpy as np
 import traceback
+import os
+import json
+import hashlib
 from queue import Queue
-from random import choice
+from heapq import heappush, heappop
+from math import inf
+from threading import Lock
+from time import perf_counter
+from concurrent.futures import Future, ThreadPoolExecutor
 
 BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
@@ -13,6 +21,20 @@ vec = pg.math.Vector2
 
 RIGHT = vec(1, 0)
 
+# cell size of the broad phase grid for the visibility tests
+GRID_SIZE = 48
+# number of node pairs that are tested in one vectorized batch
+BATCH_SIZE = 8192
+# distance of the automatic nodes from the corners of a wall
+CORNER_OFFSET = 12
+# directory that levels are saved to and loaded from
+LEVEL_DIR = 'pathfinding_level'
+# number of threads that compute paths for the mobs
+PATH_WORKERS = 2
+# bump this when a change to the visibility rules makes the
+# adjacency stored in older level files invalid
+LEVEL_FORMAT = 1
+
 # ------------- helper function ----------------------------------------------
 def limit(vector, length):
     if vector.length_squared() <= length * length:
@@ -32,6 +54,65 @@ def constrain(n, low, high):
     return max(min(n, high), low)
 
 
+def level_hash(walls, nodes, corners):
+    # identifies the graph that a layout of walls and nodes gives
+    h = hashlib.sha1(str(LEVEL_FORMAT).encode())
+    for array in (walls, nodes, corners):
+        h.update(np.ascontiguousarray(array).tobytes())
+    return h.hexdigest()
+
+
+def segment_intersects_rect(x1, y1, x2, y2, left, top, right, bottom):
+    # slab test of one line segment against a closed rect on plain floats
+    dx = x2 - x1
+    dy = y2 - y1
+    t0 = 0.0
+    t1 = 1.0
+    if dx == 0:
+        # a segment parallel to a side lies completely outside of it
+        if x1 < left or x1 > right:
+            return False
+    else:
+        ta = (left - x1) / dx
+        tb = (right - x1) / dx
+        if ta > tb:
+            ta, tb = tb, ta
+        t0 = max(t0, ta)
+        t1 = min(t1, tb)
+    if dy == 0:
+        if y1 < top or y1 > bottom:
+            return False
+    else:
+        ta = (top - y1) / dy
+        tb = (bottom - y1) / dy
+        if ta > tb:
+            ta, tb = tb, ta
+        t0 = max(t0, ta)
+        t1 = min(t1, tb)
+    return t0 <= t1
+
+
+def segments_intersect_rects(x1, y1, x2, y2, left, top, right, bottom):
+    # Liang-Barsky clipping of line segments against closed rects,
+    # all arguments are numpy arrays that broadcast against each other
+    dx = x2 - x1
+    dy = y2 - y1
+    shape = np.broadcast(x1, dx, left, top, right, bottom).shape
+    t0 = np.zeros(shape)
+    t1 = np.ones(shape)
+    hit = np.ones(shape, bool)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for p, q in ((-dx, x1 - left), (dx, right - x1),
+                     (-dy, y1 - top), (dy, bottom - y1)):
+            p, q = np.broadcast_arrays(p, q)
+            # a segment parallel to a side lies completely outside of it
+            hit &= (p != 0) | (q >= 0)
+            t = q / p
+            t0 = np.where(p < 0, np.maximum(t0, t), t0)
+            t1 = np.where(p > 0, np.minimum(t1, t), t1)
+    return hit & (t0 <= t1)
+
+
 
 class Game:
     def __init__(self):
@@ -45,21 +126,44 @@ class Game:
         self.mobs = pg.sprite.Group()
         self.walls = pg.sprite.Group()       
         # create Nodes to indicate the spawn point and the target of the Mobs
+        self.graph = VisibilityGraph(self)
+        # paths by (start, goal, k), shortest path trees by goal and
+        # copies of the trees for the path workers, all for the current
+        # graph version
+        self.path_cache = {}
+        self.tree_cache = {}
+        self.tree_snapshots = {}
+        self.cache_version = None
+        self.mobs_version = None
+        # all pairs routes of a baked level, only used as long as
+        # the graph doesn't change
+        self.route_table = None
+        self.paths = PathService(self)
+        # cached picture of the edges and the graph version it shows
+        self.edge_surface = pg.Surface(self.screen_rect.size)
+        self.edge_version = None
+        # automatic nodes by (wall, corner index), used instead of
+        # the hand placed nodes when auto_nodes is on
+        self.auto_nodes = False
+        self.corner_nodes = {}
         self.start = Node(self, (40, self.screen_rect.h // 2))
         self.finish = Node(self, (self.screen_rect.w - 40 , 
                                   self.screen_rect.h // 2))
-        for node in self.nodes:
-            node.find_neighbors()
+        self.graph.rebuild()
         # variable for placing walls
         self.rect_start = vec(0, 0)
         # text surface for instructions
         self.font = pg.font.SysFont('Arial', 18)
-        text = ('MOUSE_1: Place node | MOUSE_2: Hold and drag to place wall | '
-                'MOUSE_3: Delete nodes and walls | M: Spawn Mob | '
-                'R: Restart')
-        self.instructions = self.font.render(text, False, WHITE)
+        text = ['MOUSE_1: Place node | MOUSE_2: Hold and drag to place wall | '
+                'MOUSE_3: Delete nodes and walls | M: Spawn Mob',
+                'A: Automatic nodes | F: Show shortest paths | '
+                'B: Bake and save level | L: Load level | R: Restart']
+        self.instructions = [self.font.render(line, False, WHITE) 
+                             for line in text]
         
         self.timer = 0
+        # draw the shortest paths from start to finish
+        self.show_paths = False
 
     
     def events(self):
@@ -76,35 +180,55 @@ class Game:
                 
             if event.type == pg.KEYDOWN:
                 if event.key == pg.K_r:
-                    # clear all sprites
-                    self.all_sprites.empty()
-                    self.nodes.empty()
-                    self.mobs.empty()
-                    self.walls.empty()
+                    self.clear()
                     self.start = Node(self, (40, self.screen_rect.h // 2))
                     self.finish = Node(self, (self.screen_rect.w - 40 , 
                                               self.screen_rect.h // 2))
-                    for node in self.nodes:
-                        node.find_neighbors()
+                    self.graph.rebuild()
+                
+                elif event.key == pg.K_b:
+                    self.bake()
+                    self.save_level(LEVEL_DIR)
+                
+                elif event.key == pg.K_l and os.path.isdir(LEVEL_DIR):
+                    self.load_level(LEVEL_DIR)
                 
                 elif event.key == pg.K_m:
                     # spawns a Mob when pressing the M key
                     Mob(self, self.start.position)
                 
                 elif event.key == pg.K_f:
-                    self.find_paths(self.start, self.finish)
+                    self.show_paths = not self.show_paths
+                
+                elif event.key == pg.K_a:
+                    # switch between hand placed nodes and nodes at
+                    # the corners of the walls, both remove the other kind
+                    self.auto_nodes = not self.auto_nodes
+                    for node in self.nodes:
+                        if node not in (self.start, self.finish):
+                            node.kill()
+                    self.corner_nodes.clear()
+                    self.update_corner_nodes()
+                    self.graph.update()
 
     
     def update(self):   
-        pg.display.set_caption(str(round(self.clock.get_fps(), 2)))
+        # hand out the paths that were finished since the last frame
+        self.paths.apply()
+        stats = self.paths.stats
+        pg.display.set_caption(
+                '{} fps | paths: {} done, {} queued, {:.1f} ms wait, '
+                '{:.2f} ms compute'.format(
+                round(self.clock.get_fps(), 2), stats['done'], 
+                stats['queued'], stats['max_wait_ms'], 
+                stats['max_compute_ms']))
         self.all_sprites.update()
         
-        if self.mouse_pressed[0]:
+        if self.mouse_pressed[0] and not self.auto_nodes:
             Node(self, self.mouse_pos)
-            # call find_neighbors only when something has changed
+            # update the graph only when something has changed
             # to save on performance
-            for node in self.nodes:
-                node.find_neighbors()
+            self.graph.update()
                 
         if self.mouse_pressed[1]:
             # begin a rectangle for placing a wall
@@ -129,16 +253,18 @@ class Game:
                 Wall(self, (x, y), (abs(w), abs(h)))                
             self.rect_start = None
             
-            for node in self.nodes:
-                node.find_neighbors()
+            self.update_corner_nodes()
+            self.graph.update()
               
         if self.mouse_pressed[2]:
             # remove objects with mouse right
             for node in self.nodes:
                 if node.rect.collidepoint(self.mouse_pos):
                     node.kill()
-            for node in self.nodes:
-                node.find_neighbors()
+            self.update_corner_nodes()
+            self.graph.update()
+        
+        self.reroute_mobs()
         
         '''           
         self.timer += 1
@@ -148,9 +274,148 @@ class Game:
         
         
     
+    def clear(self):
+        # clear all sprites
+        self.all_sprites.empty()
+        self.nodes.empty()
+        self.mobs.empty()
+        self.walls.empty()
+        self.corner_nodes.clear()
+        self.route_table = None
+    
+    
+    def bake(self):
+        # computes the routes between all nodes for a level that
+        # doesn't change anymore
+        self.graph.update()
+        nodes = [self.start, self.finish] + [n for n in self.nodes 
+                                             if n not in (self.start, 
+                                                          self.finish)]
+        self.route_table = RouteTable(nodes, self.graph.version)
+    
+    
+    def save_level(self, path):
+        # writes the walls, the nodes, the edges and the baked routes to
+        # a directory of .npy files, start and finish are the first two
+        # nodes. The edges are stored as compressed sparse rows, the
+        # neighbors of node i are indices[indptr[i]:indptr[i + 1]]
+        if (self.route_table is None or 
+            self.route_table.version != self.graph.version):
+            self.bake()
+        nodes = self.route_table.nodes
+        index = self.route_table.index
+        walls = self.walls.sprites()
+        wall_index = {wall: i for i, wall in enumerate(walls)}
+        corner_of = {node: wall_index[wall] * 4 + i 
+                     for (wall, i), node in self.corner_nodes.items()}
+        walls = np.array([tuple(wall.rect) for wall in walls], 
+                         np.int32).reshape(-1, 4)
+        positions = np.array([tuple(node.position) for node in nodes], 
+                             float).reshape(-1, 2)
+        # the wall * 4 + corner index of automatic nodes, -1 for the others
+        corners = np.array([corner_of.get(node, -1) for node in nodes], 
+                           np.int32)
+        indptr = np.cumsum([0] + [len(node.neighbors) for node in nodes])
+        indices = [index[n] for node in nodes for n in node.neighbors]
+        arrays = {'walls': walls, 'nodes': positions, 'corners': corners,
+                  'indptr': indptr.astype(np.int32), 
+                  'indices': np.array(indices, np.int32)}
+        os.makedirs(path, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(os.path.join(path, name + '.npy'), array)
+        self.route_table.save(path)
+        with open(os.path.join(path, 'level.json'), 'w') as f:
+            json.dump({'format': LEVEL_FORMAT, 
+                       'graph_hash': level_hash(walls, positions, corners)}, 
+                      f, indent=2)
+    
+    
+    def load_level(self, path):
+        # the stored edges and routes are only used if the hash shows 
+        # that they belong to this layout, otherwise the graph is rebuilt.
+        # All of the layout and the edges is needed right away, so only
+        # the route tables are memory-mapped. A level of another format
+        # or with missing files isn't loaded and the current one is kept
+        try:
+            with open(os.path.join(path, 'level.json')) as f:
+                info = json.load(f)
+            if info.get('format') != LEVEL_FORMAT:
+                raise ValueError('format {} instead of {}'.format(
+                                 info.get('format'), LEVEL_FORMAT))
+            arrays = {name: np.load(os.path.join(path, name + '.npy'))
+                      for name in ('walls', 'nodes', 'corners', 'indptr', 
+                                   'indices')}
+            if len(arrays['nodes']) < 2:
+                raise ValueError('no start and finish')
+        except (OSError, ValueError) as error:
+            print('level {} not loaded: {}'.format(path, error))
+            return
+        self.clear()
+        valid = info.get('graph_hash') == level_hash(arrays['walls'], 
+                                                     arrays['nodes'],
+                                                     arrays['corners'])
+        walls = [Wall(self, rect[:2], rect[2:]) 
+                 for rect in arrays['walls'].tolist()]
+        corners = arrays['corners'].tolist()
+        self.auto_nodes = max(corners, default=-1) >= 0
+        nodes = []
+        for position, corner in zip(arrays['nodes'].tolist(), corners):
+            if corner < 0:
+                nodes.append(Node(self, position))
+            else:
+                r = walls[corner // 4].rect
+                node = Node(self, position, [vec(r.topleft), vec(r.topright), 
+                                             vec(r.bottomright), 
+                                             vec(r.bottomleft)])
+                self.corner_nodes[(walls[corner // 4], corner % 4)] = node
+                nodes.append(node)
+        self.start, self.finish = nodes[:2]
+        if valid:
+            self.graph.load(nodes, arrays['indptr'], arrays['indices'])
+            try:
+                self.route_table = RouteTable.load(path, nodes, 
+                                                   self.graph.version)
+            except (OSError, ValueError) as error:
+                # the routes are found on the fly instead
+                print('routes of level {} not loaded: {}'.format(path, 
+                                                                 error))
+        else:
+            self.graph.rebuild()
+    
+    
+    def update_corner_nodes(self):
+        # in automatic mode, places a node next to each corner of every 
+        # wall that isn't covered by another wall or outside of the screen.
+        # Together with the tangent test in Node.is_tangent this gives the
+        # shortest paths as long as no corner is skipped, i.e. the gaps
+        # between walls are wider than a node
+        if not self.auto_nodes:
+            return
+        wanted = {}
+        rects = [wall.rect for wall in self.walls]
+        for wall in self.walls:
+            r = wall.rect
+            corners = [vec(r.topleft), vec(r.topright), 
+                       vec(r.bottomright), vec(r.bottomleft)]
+            r = r.inflate(CORNER_OFFSET * 2, CORNER_OFFSET * 2)
+            inflated = [r.topleft, r.topright, r.bottomright, r.bottomleft]
+            for i, position in enumerate(inflated):
+                rect = pg.Rect(0, 0, 20, 20)
+                rect.center = position
+                if (rect.collidelist(rects) == -1 and 
+                    self.screen_rect.contains(rect)):
+                    wanted[(wall, i)] = (position, corners)
+        for key, node in list(self.corner_nodes.items()):
+            if key not in wanted or not node.alive():
+                node.kill()
+                del self.corner_nodes[key]
+        for key, (position, corners) in wanted.items():
+            if key not in self.corner_nodes:
+                self.corner_nodes[key] = Node(self, position, corners)
+    
+    
     def draw(self):
-        self.screen.fill(BLACK)
-        # draw lines between connected nodes
+        # draw lines between connected nodes on a black background
         self.draw_connections()
         self.all_sprites.draw(self.screen)
         # draw a rect if the player is holding the middle mouse button
@@ -158,27 +423,50 @@ class Game:
             w = self.mouse_pos.x - self.rect_start.x
             h = self.mouse_pos.y - self.rect_start.y       
             pg.draw.rect(self.screen, WHITE, pg.Rect(self.rect_start, (w, h)), 2)
-        # highlight neibors in red
-        for node in self.nodes:
+        # highlight the neighbors of the node under the mouse in red
+        node = self.graph.node_at(self.mouse_pos)
+        if node is not None:
             node.draw_neighbors()
+        if self.show_paths:
+            self.draw_paths()
         # draw the path of each mob
         for mob in self.mobs:
             mob.draw_path(self.screen)
         # draw instructions text on the top
-        rect = self.instructions.get_rect()
-        rect.centerx = self.screen_rect.centerx
-        rect.y = 4
-        self.screen.blit(self.instructions, rect)
+        y = 4
+        for line in self.instructions:
+            rect = line.get_rect()
+            rect.centerx = self.screen_rect.centerx
+            rect.y = y
+            self.screen.blit(line, rect)
+            y = rect.bottom
 
         pg.display.update()
     
     
+    def draw_paths(self):
+        # the best path in white and the runner-up in grey, computed only
+        # once per graph version thanks to the path cache
+        paths = self.get_paths(self.start, self.finish)
+        for path, color in reversed(list(zip(paths, (WHITE, GREY)))):
+            if len(path) > 1:
+                pg.draw.lines(self.screen, color, False, 
+                              [node.position for node in path], 4)
+    
+    
     def draw_connections(self):
-        for node in self.nodes:
-            for n in node.neighbors:
-                start = node.position
-                end = n.position
-                pg.draw.line(self.screen, GREY, start, end, 2)
+        # the edges are only drawn again when the graph has changed,
+        # and each of them only once
+        if self.edge_version != self.graph.version:
+            self.edge_surface.fill(BLACK)
+            index = self.graph.index
+            for node in self.graph.nodes:
+                for n in node.neighbors:
+                    if index[node] < index[n]:
+                        pg.draw.line(self.edge_surface, GREY, node.position, 
+                                     n.position, 2)
+            self.edge_version = self.graph.version
+        self.screen.blit(self.edge_surface, (0, 0))
     
 
     def breadth_first_search(self, start, goal):
@@ -190,7 +478,7 @@ class Game:
         # visit all nodes
         while not frontier.empty():
             current = frontier.get()
-            for next in current.find_neighbors():
+            for next in current.neighbors:
                 if next not in came_from:
                     frontier.put(next)
                     came_from[next] = current
@@ -205,24 +493,144 @@ class Game:
         return path
     
     
-    def find_paths(self, start, goal):
-        q = Queue()
+    def a_star_search(self, start, goal, blocked_nodes=(), blocked_edges=()):
+        # https://www.redblobgames.com/pathfinding/a-star/implementation.html
+        # returns the shortest path and its length or None, ignoring the
+        # given nodes and (from, to) edges
+        frontier = []
+        heappush(frontier, (0, 0, start))
+        came_from = {start: None}
+        cost_so_far = {start: 0}
+        count = 1
+        while frontier:
+            current = heappop(frontier)[2]
+            if current == goal:
+                break
+            for next in current.neighbors:
+                if next in blocked_nodes or (current, next) in blocked_edges:
+                    continue
+                new_cost = (cost_so_far[current] +
+                            current.position.distance_to(next.position))
+                if next not in cost_so_far or new_cost < cost_so_far[next]:
+                    cost_so_far[next] = new_cost
+                    # the straight line distance never overestimates
+                    priority = new_cost + next.position.distance_to(
+                                                            goal.position)
+                    heappush(frontier, (priority, count, next))
+                    count += 1
+                    came_from[next] = current
+        else:
+            return None
         path = []
-        paths = []
+        while current != start:
+            path.append(current)
+            current = came_from[current]
         path.append(start)
-        q.put(path)
-        while not q.empty():
-            path = q.get()
-            last = path[-1]
-            if last == goal:
-                paths.append(path)
-            
-            for node in last.neighbors:
-                if node not in path:
-                    newpath = list(path)
-                    newpath.append(node)
-                    q.put(newpath)
-        return sorted(paths, key=len)
+        path.reverse()
+        return path, cost_so_far[goal]
+    
+    
+    def clear_stale_caches(self):
+        # drops the cached paths and repairs the trees with the edges
+        # that changed since the last call, then copies them once for
+        # the path workers
+        if self.cache_version != self.graph.version:
+            self.path_cache.clear()
+            changes = self.graph.take_changes()
+            if changes is None:
+                self.tree_cache.clear()
+            else:
+                for tree in self.tree_cache.values():
+                    tree.update_edges(changes)
+            self.tree_snapshots = {goal: TreeSnapshot(tree, 
+                                                      self.graph.version)
+                                   for goal, tree in self.tree_cache.items()}
+            self.cache_version = self.graph.version
+    
+    
+    def reroute_mobs(self):
+        # after the graph has changed, only the mobs that can't walk
+        # straight to their current target anymore look for a new route
+        if self.mobs_version == self.graph.version:
+            return
+        self.mobs_version = self.graph.version
+        self.clear_stale_caches()
+        # mobs without a path are still waiting for one
+        mobs = [mob for mob in self.mobs if mob.path]
+        blocked = [mob for mob in mobs if not mob.target.alive()]
+        mobs = [mob for mob in mobs if mob.target.alive()]
+        if mobs:
+            clear = self.graph.lines_clear([mob.pos for mob in mobs],
+                                           [mob.target for mob in mobs],
+                                           [mob.previous for mob in mobs])
+            blocked += [mob for mob, c in zip(mobs, clear) if not c]
+        for mob in blocked:
+            mob.replan()
+    
+    
+    def get_paths(self, start, goal, k=2):
+        # returns the k shortest paths, computing them only once
+        # until the graph changes
+        self.clear_stale_caches()
+        key = (start, goal, k)
+        if key not in self.path_cache:
+            self.path_cache[key] = self.find_paths(start, goal, k)
+        return self.path_cache[key]
+    
+    
+    def get_tree_snapshot(self, goal):
+        # returns the copy of the repaired shortest path tree towards
+        # goal, or None if there is no tree yet
+        self.clear_stale_caches()
+        return self.tree_snapshots.get(goal)
+    
+    
+    def add_tree(self, tree, snapshot):
+        # takes over a tree that a path worker has built, unless the 
+        # graph has changed since, from then on the tree is repaired
+        self.clear_stale_caches()
+        if (snapshot.version == self.graph.version and tree.goal.alive() and
+            tree.goal not in self.tree_cache):
+            self.tree_cache[tree.goal] = tree
+            self.tree_snapshots[tree.goal] = snapshot
+    
+    
+    def find_paths(self, start, goal, k=2):
+        # Yen's algorithm, returns the k shortest paths without loops
+        # https://en.wikipedia.org/wiki/Yen%27s_algorithm
+        result = self.a_star_search(start, goal)
+        if result is None:
+            return []
+        paths = [result]
+        candidates = []
+        count = 0
+        while len(paths) < k:
+            last, _ = paths[-1]
+            root_cost = 0
+            for i in range(len(last) - 1):
+                # branch off the last path at each of its nodes
+                spur = last[i]
+                root = last[:i + 1]
+                if i > 0:
+                    root_cost += last[i - 1].position.distance_to(
+                                                            spur.position)
+                blocked_edges = {(path[i], path[i + 1]) for path, _ in paths
+                                 if path[:i + 1] == root}
+                result = self.a_star_search(spur, goal, set(root[:-1]),
+                                            blocked_edges)
+                if result is None:
+                    continue
+                spur_path, spur_cost = result
+                path = root[:-1] + spur_path
+                if (all(path != c[2] for c in candidates) and
+                    all(path != p for p, _ in paths)):
+                    heappush(candidates, (root_cost + spur_cost, count, path))
+                    count += 1
+            if not candidates:
+                break
+            cost, _, path = heappop(candidates)
+            paths.append((path, cost))
+        return [path for path, _ in paths]
         
               
     def run(self):
@@ -233,6 +641,7 @@ class Game:
             self.update()
             self.draw()
         
+        self.paths.close()
         pg.quit()
 
 
@@ -258,23 +667,45 @@ class Mob(pg.sprite.Sprite):
             self.kill()
             return
         '''
-        try:
-            paths = self.game.find_paths(self.game.start, 
-                                         self.game.finish)
-            self.path = choice(paths[:2])
-        except:
-            self.kill()
-            return
-
-        self.current_target = 0
-        self.target = self.path[self.current_target]
+        # the node the mob came from (None if it didn't come along an edge)
+        # and the nodes it still has to visit, None while it waits for them
+        self.previous = None
+        self.path = None
         self.speed = 6
         self.friction = 0.9
-        
-        
+        self.request({self.game.start: 0})
+    
+    
+    @property
+    def target(self):
+        return self.path[0]
+    
+    
+    def request(self, sources):
+        # asks for the shortest path to the finish that starts at one
+        # of the given nodes, sources maps them to the cost to get there
+        self.path = None
+        self.game.paths.request(sources, self.game.finish, self.set_path)
+    
+    
+    def set_path(self, path, version):
+        if not self.alive():
+            return
+        if version != self.game.graph.version:
+            # the graph changed while the path was computed
+            self.replan()
+        elif not path:
+            # if no path can be found, kill the mob
+            self.kill()
+        else:
+            self.path = path
         
     
     def update(self):
+        if not self.path:
+            # wait for the path to arrive
+            self.vel *= self.friction
+            return
         # apply motion
         self.acc += self.arrive(self.target.position)
         self.vel += self.acc * self.speed
@@ -286,12 +717,30 @@ class Mob(pg.sprite.Sprite):
         # if target is reached, set next target in path
         d = self.target.position - self.pos # distance vector to target
         if d.length() < self.speed:
-            self.current_target += 1
-            try:
-                self.target = self.path[self.current_target]
-            except:
+            self.previous = self.path.pop(0)
+            if not self.path:
                 # when there is not target left, remove the Mob
                 self.kill()
+            elif self.target not in self.previous.neighbors:
+                # the graph has changed, so re-plan from the reached node
+                self.request({self.previous: 0})
+    
+    
+    def replan(self):
+        # look for a path from any node that can be seen from here
+        graph = self.game.graph
+        nodes = [node for node in graph.nodes if node.alive()]
+        if nodes:
+            clear = graph.lines_clear([self.pos] * len(nodes), nodes,
+                                      [self.previous] * len(nodes))
+            nodes = [node for node, c in zip(nodes, clear) if c]
+        if not nodes:
+            # no way out, remove the Mob
+            self.kill()
+            return
+        self.previous = None
+        self.request({node: self.pos.distance_to(node.position) 
+                      for node in nodes})
        
     
     def arrive(self, target):
@@ -309,14 +758,366 @@ class Mob(pg.sprite.Sprite):
     
     
     def draw_path(self, screen):
-        if len(self.path) > 1:
-            lines = [node.position for node in self.path]
+        if self.path:
+            lines = [self.pos] + [node.position for node in self.path]
             pg.draw.lines(screen, RED, False, lines)
 
 
 
+class ShortestPathTree:
+    '''
+    stores the distance to a goal node and the next node on the way there
+    for every node. This is Lifelong Planning A* run backwards from the
+    goal without a heuristic, so after edges are added or removed only
+    the nodes whose distance changes are visited again
+    http://idm-lab.org/bib/abstracts/papers/aij04.pdf
+    '''
+    def __init__(self, goal, distance=None, successor=None):
+        self.goal = goal
+        self.frontier = []
+        self.queued = {}
+        self.count = 0
+        if distance is None:
+            self.distance = {}
+            # the distance through the best neighbor, which differs from
+            # distance only for nodes that still have to be processed
+            self.lookahead = {goal: 0}
+            self.successor = {goal: None}
+            self.push(goal, 0)
+            self.compute()
+        else:
+            # takes over a finished search, where both are the same
+            self.distance = distance
+            self.lookahead = dict(distance)
+            self.successor = successor
+    
+    
+    def push(self, node, key):
+        self.queued[node] = key
+        heappush(self.frontier, (key, self.count, node))
+        self.count += 1
+    
+    
+    def update_node(self, node):
+        if node is not self.goal:
+            best = inf
+            self.successor[node] = None
+            for next in node.neighbors:
+                cost = (self.distance.get(next, inf) + 
+                        node.position.distance_to(next.position))
+                if cost < best:
+                    best = cost
+                    self.successor[node] = next
+            self.lookahead[node] = best
+        dist = self.distance.get(node, inf)
+        lookahead = self.lookahead[node]
+        if dist != lookahead:
+            self.push(node, min(dist, lookahead))
+        else:
+            self.queued.pop(node, None)
+    
+    
+    def compute(self):
+        while self.frontier:
+            key, _, node = heappop(self.frontier)
+            if self.queued.get(node) != key:
+                # outdated entry
+                continue
+            del self.queued[node]
+            if self.distance.get(node, inf) > self.lookahead[node]:
+                self.distance[node] = self.lookahead[node]
+            else:
+                # the node got further away, so its neighbors
+                # might have to choose another way
+                self.distance[node] = inf
+                self.update_node(node)
+            # edges are undirected, so the neighbors lead to node
+            for next in node.neighbors:
+                self.update_node(next)
+    
+    
+    def update_edges(self, pairs):
+        # repairs the tree after the edges between the given
+        # pairs of nodes have been added or removed
+        for pair in pairs:
+            for node in pair:
+                if node.alive():
+                    self.update_node(node)
+                else:
+                    for table in (self.distance, self.lookahead, 
+                                  self.successor, self.queued):
+                        table.pop(node, None)
+        self.compute()
+
+
+
+class RouteTable:
+    '''
+    distances and next hops between all pairs of nodes, computed with
+    a vectorized Floyd-Warshall algorithm, so that any route can be
+    read off in O(path length)
+    '''
+    def __init__(self, nodes, version, distance=None, next_hop=None):
+        self.nodes = nodes
+        self.index = {node: i for i, node in enumerate(nodes)}
+        # the graph version the table is valid for
+        self.version = version
+        if distance is None:
+            distance, next_hop = self.floyd_warshall()
+        self.distance = distance
+        self.next_hop = next_hop
+    
+    
+    def floyd_warshall(self):
+        n = len(self.nodes)
+        positions = np.array([tuple(node.position) for node in self.nodes], 
+                             float).reshape(-1, 2)
+        distance = np.full((n, n), inf)
+        next_hop = np.full((n, n), -1)
+        for i, node in enumerate(self.nodes):
+            j = [self.index[other] for other in node.neighbors]
+            distance[i, j] = np.hypot(*(positions[j] - positions[i]).T)
+            next_hop[i, j] = j
+        np.fill_diagonal(distance, 0)
+        np.fill_diagonal(next_hop, np.arange(n))
+        for k in range(n):
+            # take the ways through node k where they are shorter
+            through = distance[:, k, None] + distance[None, k, :]
+            shorter = through < distance
+            distance = np.where(shorter, through, distance)
+            next_hop = np.where(shorter, next_hop[:, k, None], next_hop)
+        return distance, next_hop.astype(np.int32)
+    
+    
+    def route(self, start, goal):
+        # returns the path from start to goal or an empty list
+        path = []
+        if start not in self.index or goal not in self.index:
+            return path
+        i = self.index[start]
+        j = self.index[goal]
+        if self.next_hop[i, j] < 0:
+            return path
+        path.append(start)
+        while i != j:
+            i = int(self.next_hop[i, j])
+            path.append(self.nodes[i])
+        return path
+    
+    
+    def route_from(self, sources, goal):
+        # returns the shortest path to goal from the best of the sources,
+        # which maps nodes to the cost of getting there
+        if goal not in self.index:
+            return []
+        j = self.index[goal]
+        best = min(sources, default=None, key=lambda node: 
+                   sources[node] + self.distance[self.index[node], j] 
+                   if node in self.index else inf)
+        if best is None:
+            return []
+        return self.route(best, goal)
+    
+    
+    def save(self, path):
+        np.save(os.path.join(path, 'distance.npy'), self.distance)
+        np.save(os.path.join(path, 'next_hop.npy'), self.next_hop)
+    
+    
+    @classmethod
+    def load(cls, path, nodes, version):
+        distance = np.load(os.path.join(path, 'distance.npy'), mmap_mode='r')
+        next_hop = np.load(os.path.join(path, 'next_hop.npy'), mmap_mode='r')
+        return cls(nodes, version, distance, next_hop)
+
+
+
+class GraphSnapshot:
+    '''
+    read-only copy of the visibility graph that the path workers
+    build new shortest path trees in, while the game keeps changing
+    the nodes
+    '''
+    def __init__(self, graph):
+        # only copies what the game changes, the rest is left to
+        # the workers in compress()
+        self.version = graph.version
+        self.nodes = list(graph.nodes)
+        self.index = dict(graph.index)
+        self.positions = graph.positions.copy()
+        self.neighbors = [tuple(node.neighbors) for node in self.nodes]
+        self.indptr = None
+        # (tree, tree snapshot) by goal, shared by all requests for
+        # the same goal
+        self.trees = {}
+        self.lock = Lock()
+    
+    
+    def compress(self):
+        # edges as compressed sparse rows with their lengths
+        neighbors = [[self.index[n] for n in neighbors] 
+                     for neighbors in self.neighbors]
+        self.indptr = np.cumsum([0] + [len(n) for n in neighbors]).tolist()
+        indices = np.array([j for n in neighbors for j in n], int)
+        rows = np.repeat(np.arange(len(self.nodes)), np.diff(self.indptr))
+        d = self.positions[indices] - self.positions[rows]
+        self.indices = indices.tolist()
+        self.lengths = np.hypot(d[:, 0], d[:, 1]).tolist()
+    
+    
+    def tree(self, goal):
+        with self.lock:
+            if self.indptr is None:
+                self.compress()
+            if goal not in self.trees:
+                tree = ShortestPathTree(goal, *self.dijkstra(goal))
+                self.trees[goal] = tree, TreeSnapshot(tree, self.version)
+            return self.trees[goal]
+    
+    
+    def dijkstra(self, goal):
+        # backwards from the goal, edges are undirected. Returns the
+        # distances and successors of the nodes that can reach the goal
+        distance = [inf] * len(self.nodes)
+        successor = [-1] * len(self.nodes)
+        frontier = []
+        if goal in self.index:
+            distance[self.index[goal]] = 0
+            frontier.append((0, self.index[goal]))
+        while frontier:
+            dist, current = heappop(frontier)
+            if dist > distance[current]:
+                # outdated entry
+                continue
+            for k in range(self.indptr[current], self.indptr[current + 1]):
+                next = self.indices[k]
+                new_dist = dist + self.lengths[k]
+                if new_dist < distance[next]:
+                    distance[next] = new_dist
+                    successor[next] = current
+                    heappush(frontier, (new_dist, next))
+        reached = [i for i, dist in enumerate(distance) if dist < inf]
+        return ({self.nodes[i]: distance[i] for i in reached},
+                {self.nodes[i]: self.nodes[successor[i]] 
+                 if successor[i] >= 0 else None for i in reached})
+
+
+
+class TreeSnapshot:
+    '''
+    read-only copy of the distances and successors of a shortest path
+    tree, which the path workers read routes from while the game keeps
+    repairing the tree
+    '''
+    def __init__(self, tree, version):
+        self.version = version
+        self.distance = dict(tree.distance)
+        self.successor = dict(tree.successor)
+    
+    
+    def route(self, sources):
+        # returns the shortest path to the goal from the best of the sources
+        # (a dict of nodes and the cost of getting there) or an empty list
+        best, cost = None, inf
+        for node, start_cost in sources.items():
+            if start_cost + self.distance.get(node, inf) < cost:
+                best, cost = node, start_cost + self.distance[node]
+        path = []
+        while best is not None:
+            path.append(best)
+            best = self.successor[best]
+        return path
+
+
+
+class PathService:
+    '''
+    queue of path requests that a pool of worker threads computes. For
+    a goal without a shortest path tree, a worker builds one on a
+    snapshot of the graph and the game takes it over, otherwise the
+    workers read the routes off a snapshot of the repaired tree. The
+    results are handed to the callbacks in apply(), once per frame,
+    together with the graph version they belong to
+    '''
+    def __init__(self, game, workers=PATH_WORKERS):
+        self.game = game
+        self.worker = ThreadPoolExecutor(max_workers=workers)
+        self.snapshot = None
+        # (future, callback, time of the request) that are not applied yet
+        self.pending = []
+        # paths applied in the last frame, how many are still in the
+        # queue, the longest time one of them waited besides being
+        # computed and the longest time a worker computed one
+        self.stats = {'done': 0, 'queued': 0, 'max_wait_ms': 0.0,
+                      'max_compute_ms': 0.0}
+    
+    
+    def request(self, sources, goal, callback):
+        graph = self.game.graph
+        table = self.game.route_table
+        if table is not None and table.version == graph.version:
+            # baked routes are cheap to read, no need for a worker
+            future = Future()
+            future.set_result((table.route_from(sources, goal), 
+                               graph.version, None, 0.0))
+        else:
+            tree = self.game.get_tree_snapshot(goal)
+            if tree is None and (self.snapshot is None or 
+                                 self.snapshot.version != graph.version):
+                self.snapshot = GraphSnapshot(graph)
+            future = self.worker.submit(self.search, tree, self.snapshot,
+                                        sources, goal)
+        self.pending.append((future, callback, perf_counter()))
+        return future
+    
+    
+    def search(self, tree, snapshot, sources, goal):
+        # returns the path, the graph version, the (tree, tree snapshot)
+        # built here or None and the seconds it took
+        start = perf_counter()
+        built = None
+        if tree is None:
+            built = snapshot.tree(goal)
+            tree = built[1]
+        path = tree.route(sources)
+        return path, tree.version, built, perf_counter() - start
+    
+    
+    def apply(self):
+        now = perf_counter()
+        done = []
+        waiting = []
+        for request in self.pending:
+            # a future can finish at any time, so it's only checked once
+            if request[0].done():
+                done.append(request)
+            else:
+                waiting.append(request)
+        self.pending = waiting
+        results = [(future.result(), callback, t) 
+                   for future, callback, t in done]
+        self.stats = {'done': len(done), 'queued': len(self.pending),
+                      'max_wait_ms': max([(now - t - r[3]) * 1000 
+                                          for r, _, t in results], 
+                                         default=0.0),
+                      'max_compute_ms': max([r[3] * 1000 
+                                             for r, _, _ in results], 
+                                            default=0.0)}
+        # new trees first, so that requests of the callbacks can use them
+        for (path, version, built, _), _, _ in results:
+            if built is not None:
+                self.game.add_tree(*built)
+        for (path, version, _, _), callback, _ in results:
+            callback(path, version)
+    
+    
+    def close(self):
+        self.worker.shutdown(wait=False, cancel_futures=True)
+
+
+
 class Node(pg.sprite.Sprite):
-    def __init__(self, game, position):
+    def __init__(self, game, position, wall_corners=None):
         super().__init__(game.all_sprites, game.nodes)
         self.game = game
         self.image = pg.Surface((20, 20))
@@ -325,6 +1126,19 @@ class Node(pg.sprite.Sprite):
         self.rect.center = position
         self.position = vec(position)
         self.neighbors = []
+        # for automatic nodes the corner positions of their wall
+        self.wall_corners = wall_corners
+    
+    
+    def is_tangent(self, other):
+        # an edge at a wall corner is only useful if the whole wall stays
+        # on one side of it, otherwise a path could cut the corner shorter
+        if self.wall_corners is None:
+            return True
+        d = other.position - self.position
+        sides = [d.cross(corner - self.position) 
+                 for corner in self.wall_corners]
+        return min(sides) >= 0 or max(sides) <= 0
     
     
     def __repr__(self):
@@ -333,28 +1147,14 @@ class Node(pg.sprite.Sprite):
     
     def find_neighbors(self):
         # cast a ray to each other node and if it doesn't intersect a wall
-        # add that node to neighbors
-        self.neighbors.clear()
-        for node in self.game.nodes:
-            if node != self:
-                dist = Line(self.position, node.position)
-                intersects = False
-                for wall in self.game.walls:
-                    if dist.intersects_rect(wall.rect):
-                        intersects = True
-                for other in self.game.nodes:
-                    if (other != self and other != node and
-                        dist.intersects_rect(other.rect)):
-                        intersects = True
-                if not intersects:
-                    self.neighbors.append(node)
+        # or another node add that node to neighbors
+        self.neighbors = self.game.graph.visible_from(self)
         return self.neighbors
     
     
     def draw_neighbors(self):
         for node in self.neighbors:
-            if self.rect.collidepoint(self.game.mouse_pos):
-                pg.draw.rect(self.game.screen, RED, node.rect)
+            pg.draw.rect(self.game.screen, RED, node.rect)
                 
                
     
@@ -395,12 +1195,11 @@ class Line:
         # checks if two Line objects intersect
         #http://www.jeffreythompson.org/collision-detection/line-rect.php
         # calculate denominators for uA and uB
-        denA = ((other.end.y - other.start.y) * (self.end.x - self.start.x) - 
-                (other.end.x - other.start.x) * (self.end.y - self.start.y))
-        denB = ((other.end.y - other.start.y) * (self.end.x - self.start.x) - 
-                (other.end.x - other.start.x) * (self.end.y - self.start.y))
-        if denA == 0 or denB == 0:
-            # if any denominator is 0, the lines are parallel and don't intersect
+        # (both share the same denominator)
+        den = ((other.end.y - other.start.y) * (self.end.x - self.start.x) - 
+               (other.end.x - other.start.x) * (self.end.y - self.start.y))
+        if den == 0:
+            # if the denominator is 0, the lines are parallel and don't intersect
             return False
         else:
             # calculate numerators for uA and uB
@@ -408,8 +1207,8 @@ class Line:
                     (other.end.y - other.start.y) * (self.start.x - other.start.x))
             numB = ((self.end.x - self.start.x) * (self.start.y - other.start.y) - 
                     (self.end.y - self.start.y) * (self.start.x - other.start.x))
-            uA = numA / denA
-            uB = numB / denB
+            uA = numA / den
+            uB = numB / den
             return (uA >= 0 and uA <= 1 and uB >= 0 and uB <= 1)
 
     
@@ -423,14 +1222,383 @@ class Line:
 
     
     def intersects_rect(self, rect):
-        # checks if this line intersects any lines from a given rect
-        lines = self.get_lines_from_rect(rect)
-        for line in lines:
-            if self.intersects_line(line):
-                return True
-        return False
+        # checks if this line touches a given rect. Unlike testing against
+        # the 4 sides of the rect this is also true for a line that lies
+        # completely inside the rect or runs along one of its sides
+        return segment_intersects_rect(self.start.x, self.start.y,
+                                       self.end.x, self.end.y, rect.left,
+                                       rect.top, rect.right, rect.bottom)
+    
     
+    def intersects_rects(self, rects):
+        # same as intersects_rect for an array of (left, top, right, bottom)
+        # rows, returns a boolean array
+        rects = np.asarray(rects, float).reshape(-1, 4)
+        return segments_intersect_rects(self.start.x, self.start.y,
+                                        self.end.x, self.end.y, rects[:, 0],
+                                        rects[:, 1], rects[:, 2], rects[:, 3])
     
+    
+
+class RectGrid:
+    '''
+    uniform grid over a list of rects (left, top, right, bottom) that
+    finds the rects a batch of line segments could touch
+    '''
+    def __init__(self, rects, cell_size=GRID_SIZE):
+        self.cell_size = cell_size
+        self.rects = np.asarray(rects, float).reshape(-1, 4)
+        if len(self.rects):
+            self.origin = self.rects[:, :2].min(axis=0)
+            corner = self.rects[:, 2:].max(axis=0)
+        else:
+            self.origin = corner = np.zeros(2)
+        self.cols, self.rows = (corner - self.origin) // cell_size + 1
+        self.cols, self.rows = int(self.cols), int(self.rows)
+        # every rect is stored in each cell its closed area touches
+        low = self.cell(self.rects[:, :2])
+        high = self.cell(self.rects[:, 2:])
+        widths = high[:, 0] - low[:, 0] + 1
+        heights = high[:, 1] - low[:, 1] + 1
+        counts = widths * heights
+        ids = np.repeat(np.arange(len(self.rects)), counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                counts)
+        cols = low[ids, 0] + k % widths[ids]
+        rows = low[ids, 1] + k // widths[ids]
+        cells = rows * self.cols + cols
+        order = np.argsort(cells, kind='stable')
+        self.cell_rects = ids[order]
+        self.cell_start = np.searchsorted(cells[order],
+                                          np.arange(self.cols * self.rows + 1))
+    
+    
+    def cell(self, points):
+        cells = ((points - self.origin) // self.cell_size).astype(int)
+        return np.clip(cells, 0, (self.cols - 1, self.rows - 1))
+    
+    
+    def traverse(self, p1, p2):
+        # returns (segment index, cell index) for every grid cell each
+        # segment passes through, by splitting the segments at the grid lines
+        a = (p1 - self.origin) / self.cell_size
+        b = (p2 - self.origin) / self.cell_size
+        d = b - a
+        first = np.floor(a).astype(int)
+        steps = np.floor(b).astype(int) - first
+        segs = [np.arange(len(a))]
+        ts = [np.zeros(len(a))]
+        for axis in (0, 1):
+            n = np.abs(steps[:, axis])
+            seg = np.repeat(np.arange(len(a)), n)
+            k = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+            lines = np.where(steps[seg, axis] > 0, first[seg, axis] + 1 + k,
+                             first[seg, axis] - k)
+            segs.append(seg)
+            ts.append((lines - a[seg, axis]) / d[seg, axis])
+        seg = np.concatenate(segs)
+        t = np.concatenate(ts)
+        order = np.argsort(seg + t * 0.5)
+        seg, t = seg[order], t[order]
+        # sample the middle of each piece to find the cell it lies in
+        t_next = np.ones_like(t)
+        same = seg[1:] == seg[:-1]
+        t_next[:-1][same] = t[1:][same]
+        mid = a[seg] + d[seg] * ((t + t_next) / 2)[:, None]
+        cells = np.clip(np.floor(mid).astype(int), 0,
+                        (self.cols - 1, self.rows - 1))
+        return seg, cells[:, 1] * self.cols + cells[:, 0]
+    
+    
+    def find(self, point):
+        # returns the index of a rect that contains the point or -1,
+        # only testing the rects in the point's cell
+        if not len(self.rects):
+            return -1
+        x, y = point
+        col, row = self.cell(np.array([[x, y]], float))[0]
+        cell = row * self.cols + col
+        start, end = self.cell_start[cell], self.cell_start[cell + 1]
+        for i in self.cell_rects[start:end].tolist():
+            left, top, right, bottom = self.rects[i]
+            # same as pygame's Rect.collidepoint
+            if left <= x < right and top <= y < bottom:
+                return i
+        return -1
+    
+    
+    def first_hit(self, p1, p2, exclude=None):
+        # returns the index of a rect that each segment touches or -1,
+        # ignoring the rect ids in the matching row of exclude
+        hit = np.full(len(p1), -1)
+        if not len(p1) or not len(self.rects):
+            return hit
+        d = p2 - p1
+        length = np.hypot(d[:, 0], d[:, 1])
+        length[length == 0] = 1
+        # walk along the segments in stretches of growing length, so that
+        # the cells behind the first obstacle are never visited
+        low, high = 0, self.cell_size // 2
+        live = np.arange(len(p1))
+        while len(live):
+            t0 = np.minimum(low / length[live], 1)[:, None]
+            t1 = np.minimum(high / length[live], 1)[:, None]
+            a = p1[live] + d[live] * t0
+            b = p1[live] + d[live] * t1
+            seg, cells = self.traverse(a, b)
+            self.test_cells(p1, p2, live[seg], cells, exclude, hit)
+            live = live[(hit[live] < 0) & (length[live] > high)]
+            low, high = high, high * 2
+        return hit
+    
+    
+    def test_cells(self, p1, p2, seg, cells, exclude, hit):
+        start = self.cell_start[cells]
+        counts = self.cell_start[cells + 1] - start
+        seg = np.repeat(seg, counts)
+        k = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts,
+                                                counts)
+        ids = self.cell_rects[np.repeat(start, counts) + k]
+        r = self.rects[ids]
+        a = p1[seg]
+        b = p2[seg]
+        touches = segments_intersect_rects(a[:, 0], a[:, 1], b[:, 0], b[:, 1],
+                                           r[:, 0], r[:, 1], r[:, 2], r[:, 3])
+        seg, ids = seg[touches], ids[touches]
+        if exclude is not None:
+            keep = (ids != exclude[seg, 0]) & (ids != exclude[seg, 1])
+            seg, ids = seg[keep], ids[keep]
+        hit[seg] = ids
+        
+
+
+class VisibilityGraph:
+    '''
+    connects every pair of nodes whose connecting line touches
+    neither a wall nor a third node and is tangent at wall corners, 
+    and keeps the graph up to date
+    when walls and nodes are added or removed
+    '''
+    def __init__(self, game):
+        self.game = game
+        self.walls = []
+        self.nodes = []
+        # each pair of nodes that can't see each other is stored with
+        # one obstacle that is in the way, and each obstacle with the
+        # pairs it blocks, so that only these are tested when it is removed
+        self.blocker = {}
+        self.blocked = {}
+        # counts the edits, so that anything computed on the graph
+        # can tell if it is out of date
+        self.version = 0
+        # the node pairs whose edge was added or removed since the last
+        # call of take_changes, None after a rebuild
+        self.changes = []
+        # False after loading the edges from a file, which doesn't
+        # store the blockers that removing an obstacle would need
+        self.blockers_known = True
+    
+    
+    def obstacles(self):
+        # walls first, then the nodes in the same order as game.nodes,
+        # leaving out corner nodes which are only waypoints
+        self.walls = self.game.walls.sprites()
+        self.nodes = self.game.nodes.sprites()
+        self.index = {node: i for i, node in enumerate(self.nodes)}
+        occluding = [i for i, n in enumerate(self.nodes)
+                     if n.wall_corners is None]
+        self.obstacle_list = self.walls + [self.nodes[i] for i in occluding]
+        rects = [(s.rect.left, s.rect.top, s.rect.right, s.rect.bottom)
+                 for s in self.obstacle_list]
+        self.grid = RectGrid(rects)
+        # all node rects, for finding the node under the mouse
+        self.node_grid = RectGrid([(n.rect.left, n.rect.top, n.rect.right, 
+                                    n.rect.bottom) for n in self.nodes])
+        # the index of each node's rect in the grid or -1
+        self.rect_index = np.full(len(self.nodes), -1)
+        self.rect_index[occluding] = len(self.walls) + np.arange(
+                                                            len(occluding))
+        positions = np.array([tuple(n.position) for n in self.nodes], float)
+        self.positions = positions.reshape(-1, 2)
+    
+    
+    def connect(self, a, b):
+        a.neighbors.append(b)
+        b.neighbors.append(a)
+        if self.changes is not None:
+            self.changes.append((a, b))
+    
+    
+    def disconnect(self, a, b):
+        a.neighbors.remove(b)
+        b.neighbors.remove(a)
+        if self.changes is not None:
+            self.changes.append((a, b))
+    
+    
+    def take_changes(self):
+        changes = self.changes
+        self.changes = []
+        return changes
+    
+    
+    def block(self, a, b, obstacle):
+        pair = frozenset((a, b))
+        self.blocker[pair] = obstacle
+        self.blocked.setdefault(obstacle, set()).add(pair)
+    
+    
+    def test_pairs(self, first, second):
+        # connects the node pairs (given as indices into self.nodes)
+        # that can see each other and stores a blocker for the others
+        for i in range(0, len(first), BATCH_SIZE):
+            a = first[i:i + BATCH_SIZE]
+            b = second[i:i + BATCH_SIZE]
+            # a line always touches the rects of its own end nodes
+            exclude = np.stack((self.rect_index[a], self.rect_index[b]), 
+                               axis=1)
+            hit = self.grid.first_hit(self.positions[a], self.positions[b],
+                                      exclude)
+            for j, k, h in zip(a.tolist(), b.tolist(), hit.tolist()):
+                node, other = self.nodes[j], self.nodes[k]
+                if h >= 0:
+                    self.block(node, other, self.obstacle_list[h])
+                elif node.is_tangent(other) and other.is_tangent(node):
+                    # pairs that aren't tangent never become edges, so
+                    # they don't need to be stored
+                    self.connect(node, other)
+    
+    
+    def rebuild(self):
+        self.version += 1
+        self.changes = None
+        self.blockers_known = True
+        self.obstacles()
+        self.blocker.clear()
+        self.blocked.clear()
+        for node in self.nodes:
+            node.neighbors = []
+        # the relation is symmetric, so each pair is only tested once
+        first, second = np.triu_indices(len(self.nodes), 1)
+        self.test_pairs(first, second)
+    
+    
+    def load(self, nodes, indptr, indices):
+        # takes over stored edges instead of testing the node pairs, which
+        # only costs one pass over the edges to make the neighbor lists.
+        # The neighbors of nodes[i] are indices[indptr[i]:indptr[i + 1]]
+        self.version += 1
+        self.changes = None
+        self.blockers_known = False
+        self.obstacles()
+        self.blocker.clear()
+        self.blocked.clear()
+        indptr = np.asarray(indptr).tolist()
+        indices = np.asarray(indices).tolist()
+        for i, node in enumerate(nodes):
+            node.neighbors = [nodes[j] for j in 
+                              indices[indptr[i]:indptr[i + 1]]]
+    
+    
+    def update(self):
+        # applies the walls and nodes that were added or removed since
+        # the last call, testing only the pairs that could have changed
+        old_walls = set(self.walls)
+        old_nodes = set(self.nodes)
+        self.obstacles()
+        removed_nodes = old_nodes - set(self.nodes)
+        removed = (old_walls - set(self.walls)) | removed_nodes
+        if removed and not self.blockers_known:
+            # the pairs that the removed obstacles blocked are unknown
+            self.rebuild()
+            return
+        added = [s for s in self.walls + self.nodes
+                 if s not in old_walls and s not in old_nodes]
+        added_obstacles = [s for s in added if s in self.walls or 
+                           s.wall_corners is None]
+        if removed or added:
+            self.version += 1
+        
+        # forget the edges and blocked pairs of removed nodes
+        for node in removed_nodes:
+            for other in list(node.neighbors):
+                self.disconnect(node, other)
+            for other in list(old_nodes):
+                pair = frozenset((node, other))
+                if pair in self.blocker:
+                    self.blocked[self.blocker.pop(pair)].discard(pair)
+        # the pairs that were blocked by a removed obstacle need a new test
+        retest = []
+        for sprite in removed:
+            for pair in self.blocked.pop(sprite, ()):
+                del self.blocker[pair]
+                retest.append(tuple(self.index[node] for node in pair))
+        
+        if added_obstacles:
+            # new obstacles cut the existing edges they touch
+            edges = [(i, self.index[n]) for i, node in enumerate(self.nodes)
+                     for n in node.neighbors if i < self.index[n]]
+            if edges:
+                edges = np.array(edges)
+                p1 = self.positions[edges[:, 0]][:, None]
+                p2 = self.positions[edges[:, 1]][:, None]
+                r = np.array([(s.rect.left, s.rect.top, s.rect.right,
+                               s.rect.bottom) for s in added_obstacles], 
+                             float)
+                touches = segments_intersect_rects(
+                        p1[..., 0], p1[..., 1], p2[..., 0], p2[..., 1],
+                        r[:, 0], r[:, 1], r[:, 2], r[:, 3])
+                cut = np.flatnonzero(touches.any(axis=1))
+                for e, k in zip(cut.tolist(),
+                                touches[cut].argmax(axis=1).tolist()):
+                    a = self.nodes[edges[e, 0]]
+                    b = self.nodes[edges[e, 1]]
+                    self.disconnect(a, b)
+                    self.block(a, b, added_obstacles[k])
+        
+        if retest:
+            retest = np.array(retest)
+            self.test_pairs(retest[:, 0], retest[:, 1])
+        
+        # new nodes are tested against every other node once
+        new = np.array([i for i, node in enumerate(self.nodes)
+                        if node not in old_nodes], int)
+        if len(new):
+            is_new = np.zeros(len(self.nodes), bool)
+            is_new[new] = True
+            first = np.repeat(new, len(self.nodes))
+            second = np.tile(np.arange(len(self.nodes)), len(new))
+            keep = (first != second) & (~is_new[second] | (second > first))
+            self.test_pairs(first[keep], second[keep])
+    
+    
+    def visible_from(self, node):
+        # returns all nodes that can be seen from the given node
+        self.update()
+        return list(node.neighbors)
+    
+    
+    def node_at(self, point):
+        # returns the node whose rect contains the point or None
+        i = self.node_grid.find(point)
+        if i < 0:
+            return None
+        return self.nodes[i]
+    
+    
+    def lines_clear(self, positions, nodes, ignore):
+        # tests the lines from each position to the matching node against
+        # the walls and nodes, ignoring the rects of that node and of the
+        # matching node in ignore (which may be None)
+        p1 = np.array([tuple(p) for p in positions], float).reshape(-1, 2)
+        i = np.array([self.index[node] for node in nodes], int)
+        exclude = np.stack((self.rect_index[i], 
+                            [self.rect_index[self.index[n]] 
+                             if n in self.index else -1 for n in ignore]), 
+                           axis=1)
+        return self.grid.first_hit(p1, self.positions[i], exclude) < 0
+    
+
        
 if __name__ == '__main__':
     try:
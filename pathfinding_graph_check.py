@@ -0,0 +1,62 @@
+'''
+Randomised check that the incrementally updated visibility graph in
+pathfinding.py matches a full rebuild. Runs without a window:
+
+    SDL_VIDEODRIVER=dummy python pathfinding_graph_check.py
+'''
+import os
+import sys
+from random import Random
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+
+import pathfinding as pf
+
+
+def edges(game):
+    return {frozenset((node, n)) for node in game.nodes
+            for n in node.neighbors}
+
+
+def random_edit(game, rnd):
+    w, h = game.screen_rect.size
+    r = rnd.random()
+    if r < 0.4:
+        pf.Node(game, (rnd.randint(0, w), rnd.randint(0, h)))
+    elif r < 0.65:
+        pf.Wall(game, (rnd.randint(0, w - 40), rnd.randint(0, h - 40)),
+                (rnd.randint(3, 150), rnd.randint(3, 150)))
+    elif r < 0.85 and len(game.nodes) > 2:
+        rnd.choice(game.nodes.sprites()).kill()
+    elif game.walls:
+        rnd.choice(game.walls.sprites()).kill()
+
+
+def check(seed=0, rounds=30, edits=5):
+    # applies a few random edits per round and compares the updated
+    # graph with a rebuilt one, returns the number of mismatches
+    rnd = Random(seed)
+    game = pf.Game()
+    for i in range(20):
+        pf.Node(game, (rnd.randint(0, 1024), rnd.randint(0, 768)))
+    game.graph.rebuild()
+    mismatches = 0
+    for i in range(rounds):
+        for j in range(edits):
+            random_edit(game, rnd)
+            game.graph.update()
+        updated = edges(game)
+        game.graph.rebuild()
+        if updated != edges(game):
+            mismatches += 1
+            print('round {}: {} edges differ'.format(
+                  i, len(updated ^ edges(game))))
+    game.paths.close()
+    pf.pg.quit()
+    return mismatches
+
+
+if __name__ == '__main__':
+    mismatches = check()
+    print('{} mismatches'.format(mismatches))
+    sys.exit(1 if mismatches else 0)
@@ -1,8 +1,18 @@
 import pygame as pg
 import traceback
+import argparse
+import json
+import random as rnd
 from random import randint, randrange, uniform, random
+from heapq import heapify, heappush, heappop
+from concurrent.futures import Future, ThreadPoolExecutor
+from bisect import insort
+from operator import attrgetter
+from collections import defaultdict
+from contextlib import contextmanager
+from time import perf_counter
 import math
-import noise
+import numpy as np
 
 vec = pg.math.Vector2
 
@@ -10,13 +20,36 @@ WIDTH = 1000
 HEIGHT = 800
 
 # simulation mode
-# modes = 'wander', 'arrive', 'follow', 'path'
-# TODO: make an iterable of modes
+MODES = ('wander', 'arrive', 'follow', 'path', 'goal')
 MODE = 'follow'
 
 FPS = 60
 FLOWFIELD_COLOR = (10, 100, 50)
 BG_COLOR = (10, 40, 70)
+OBSTACLE_COLOR = (70, 40, 40)
+GOAL_COLOR = (0, 150, 0)
+# angular resolution of the pre-rendered vehicle images (in degrees)
+ROTATION_STEP = 2
+
+UP = vec(0, -1)
+
+# path following: vehicles steer back to the path when their predicted
+# position is more than PATH_RADIUS away from it
+PATH_RADIUS = 20
+PATH_LOOKAHEAD = 25
+
+# (row, column) offsets of the 8 neighbours of a grid cell and the length
+# of the step to them
+NEIGHBORS = [(-1, 0, 1), (1, 0, 1), (0, -1, 1), (0, 1, 1),
+             (-1, -1, math.sqrt(2)), (-1, 1, math.sqrt(2)),
+             (1, -1, math.sqrt(2)), (1, 1, math.sqrt(2))]
+
+# gradient directions for the 2d perlin noise (the x and y components of
+# Ken Perlin's 3d gradient set, as used by noise.pnoise2)
+GRAD2 = np.array([(1, 1), (-1, 1), (1, -1), (-1, -1),
+                  (1, 0), (-1, 0), (1, 0), (-1, 0),
+                  (0, 1), (0, -1), (0, 1), (0, -1),
+                  (1, 1), (0, -1), (-1, 1), (0, -1)], dtype=float)
 
 
 # ----------- helper functions ------------------------------------------------
@@ -44,26 +77,132 @@ def create_random_vec():
     return vec(math.cos(angle), math.sin(angle))
 
 
+def grid_pairs(positions, cell_size):
+    """
+    Sorts the points into a uniform grid and returns the index arrays
+    (i, j) of all pairs of points in the same or in neighbouring cells.
+    Each pair is returned once
+    """
+    n = len(positions)
+    cells = np.floor(positions / cell_size).astype(int)
+    cells -= cells.min(axis=0)
+    grid_w, grid_h = cells.max(axis=0) + 1
+    ids = cells[:, 1] * grid_w + cells[:, 0]
+    # points sorted by cell, with the first index and count of each cell
+    order = np.argsort(ids, kind='stable')
+    counts = np.bincount(ids, minlength=grid_w * grid_h)
+    starts = np.cumsum(counts) - counts
+    # position of each point in the sorted order
+    rank = np.empty(n, dtype=int)
+    rank[order] = np.arange(n)
+
+    cell_counts = []
+    cell_starts = []
+    # the own cell and half of the neighbours, the other half is covered
+    # by those neighbours looking back at this cell
+    for dx, dy in ((0, 0), (1, 0), (-1, 1), (0, 1), (1, 1)):
+        x = cells[:, 0] + dx
+        y = cells[:, 1] + dy
+        inside = (x >= 0) & (x < grid_w) & (y >= 0) & (y < grid_h)
+        other = np.where(inside, y * grid_w + x, 0)
+        if dx == dy == 0:
+            # in the own cell, only pair with the points sorted after this
+            cell_counts.append(starts[ids] + counts[ids] - rank - 1)
+            cell_starts.append(rank + 1)
+        else:
+            cell_counts.append(np.where(inside, counts[other], 0))
+            cell_starts.append(starts[other])
+    cell_counts = np.concatenate(cell_counts)
+    cell_starts = np.concatenate(cell_starts)
+
+    # expand every (point, neighbouring cell) into one pair per point in it
+    i = np.repeat(np.tile(np.arange(n), 5), cell_counts)
+    offsets = np.cumsum(cell_counts) - cell_counts
+    within = np.arange(len(i)) - np.repeat(offsets, cell_counts)
+    j = order[np.repeat(cell_starts, cell_counts) + within]
+    return i, j
+
+
+def separation_forces(pos, vel, separation, maxspeed, maxforce):
+    """
+    Vectorised Vehicle.separate() for all vehicles at once, takes (n, 2)
+    arrays of positions and velocities and per-vehicle arrays of the
+    desired separation, max speed and max force
+    """
+    n = len(pos)
+    # the cell size covers the largest separation, so no neighbour is missed
+    i, j = grid_pairs(pos, separation.max())
+    diff = pos[i] - pos[j]
+    d = np.hypot(diff[:, 0], diff[:, 1])
+    # every pair pushes both vehicles apart, each within its own range
+    near_i = (d > 0) & (d < separation[i])
+    near_j = (d > 0) & (d < separation[j])
+    receiver = np.concatenate((i[near_i], j[near_j]))
+    d = np.concatenate((d[near_i], d[near_j]))[:, None]
+    diff = np.concatenate((diff[near_i], -diff[near_j]))
+    # normalized difference, weighted by 1 / distance
+    diff = diff / d / d
+
+    count = np.bincount(receiver, minlength=n)
+    v_sum = np.zeros((n, 2))
+    v_sum[:, 0] = np.bincount(receiver, diff[:, 0], minlength=n)
+    v_sum[:, 1] = np.bincount(receiver, diff[:, 1], minlength=n)
+    found = count > 0
+    v_sum[found] /= count[found, None]
+    length = np.hypot(v_sum[:, 0], v_sum[:, 1])
+    length[length == 0] = 1
+    v_sum *= (maxspeed / length)[:, None]
+
+    steer = v_sum - vel
+    length = np.hypot(steer[:, 0], steer[:, 1])
+    too_long = length > maxforce
+    steer[too_long] *= (maxforce[too_long] / length[too_long])[:, None]
+    steer[~found] = 0
+    return steer
+
+
 # ---------- game class -------------------------------------------------------
 
 class Game:
-    def __init__(self):
+    def __init__(self, headless=False):
         pg.init()
-        self.screen = pg.display.set_mode((WIDTH, HEIGHT))
+        self.headless = headless
+        if headless:
+            # draw() still works, but only onto an off-screen surface
+            self.screen = pg.Surface((WIDTH, HEIGHT))
+        else:
+            self.screen = pg.display.set_mode((WIDTH, HEIGHT))
         self.clock = pg.time.Clock()
         self.running = True
-        self.all_sprites = pg.sprite.LayeredUpdates()
-        self.vehicles = pg.sprite.LayeredUpdates()
+        self.renderer = Renderer()
+        self.vehicles = pg.sprite.Group()
 
         self.flowfield = None
         self.show_field = True
+        # cached flow field overlay and the field version it shows
+        self.field_surface = pg.Surface((WIDTH, HEIGHT))
+        self.field_version = None
+        # interpolate the flow field between the cells
+        self.smooth_field = True
+        # let the flow field follow perlin noise instead of random changes
+        self.noise_field = False
+        # pre-rendered vehicle rotations, keyed by (size, color)
+        self.rotation_caches = {}
+        self.particles = None
         self.path = []
+        self.path_index = PathIndex()
         self.num_boids = 40
         self.mode = MODE
-
-    def new(self):
+        # the point vehicles arrive at in 'arrive' mode
+        self.mouse = vec(WIDTH / 2, HEIGHT / 2)
+        # compute the flow field on a background thread
+        self.background_field = True
+        # seconds spent in each phase of update(), if not None
+        self.timings = None
+
+    def new(self, seed=None):
         # start a new game
-        self.all_sprites.empty()
+        self.renderer.clear()
         self.vehicles.empty()
 
         for i in range(self.num_boids):
@@ -71,10 +210,19 @@ class Game:
             size = randint(10, 50)
             Vehicle(self, (size, int(size * 1.4)), pos)
 
-        self.flowfield = FlowField(50)
+        if self.flowfield is not None:
+            self.flowfield.close()
+        self.flowfield = FlowField(50, background=self.background_field,
+                                   seed=seed)
+        self.field_version = None
+        if self.mode == 'goal':
+            self.flowfield.set_goal(vec(WIDTH / 2, HEIGHT / 2))
+        # a particle lives 17 frames and a vehicle emits every 2nd frame
+        self.particles = ParticleSystem(self.num_boids * 16)
+        # particles are drawn beneath all vehicles
+        self.renderer.add(self.particles, -1)
         self.path = []
-
-        self.run()
+        self.path_index = PathIndex()
 
     def run(self):
         # game loop
@@ -84,34 +232,101 @@ class Game:
             self.update()
             self.draw()
 
-    def update(self):
-        # game loop update
-        self.all_sprites.update()
-
-        for v in self.vehicles:
-            v.separate(self.vehicles)
+    @contextmanager
+    def phase(self, name):
+        # adds the time spent in the block to self.timings[name]
+        if self.timings is None:
+            yield
+            return
+        start = perf_counter()
+        yield
+        self.timings[name] += perf_counter() - start
 
-        # self.flowfield.changeNoise()
-        self.flowfield.change()
+    def update(self):
+        # game loop update, in phases (the same as calling v.update() for
+        # every vehicle, followed by the separation)
+        vehicles = self.vehicles.sprites()
+        with self.phase('particles'):
+            self.particles.update()
+
+        with self.phase('steering'):
+            if self.mode in ('follow', 'goal'):
+                # look up the flow field for all vehicles in one batch
+                positions = [(v.pos.x, v.pos.y) for v in vehicles]
+                if self.smooth_field:
+                    flows = self.flowfield.sample_many(positions)
+                else:
+                    flows = self.flowfield.lookup_many(positions)
+                for v, flow in zip(vehicles, flows):
+                    v.flow.update(flow[0], flow[1])
+            for v in vehicles:
+                v.steer_mode()
+                v.move()
+
+        with self.phase('rotation'):
+            for v in vehicles:
+                v.rotate()
+
+        with self.phase('particles'):
+            for v in vehicles:
+                v.emit_particle()
+
+        with self.phase('separation'):
+            self.separate()
+
+        with self.phase('field'):
+            if self.mode == 'goal':
+                # the field only changes with the goal or the obstacles
+                self.flowfield.blend()
+            elif self.noise_field:
+                self.flowfield.change_noise()
+            else:
+                self.flowfield.change()
+
+    def separate(self):
+        # same as calling v.separate(self.vehicles) for every vehicle
+        vehicles = self.vehicles.sprites()
+        if not vehicles:
+            return
+        pos = np.array([(v.pos.x, v.pos.y) for v in vehicles])
+        vel = np.array([(v.vel.x, v.vel.y) for v in vehicles])
+        separation = np.array([v.size[0] * 4 for v in vehicles], dtype=float)
+        maxspeed = np.array([v.maxspeed for v in vehicles])
+        maxforce = np.array([v.maxforce for v in vehicles])
+        steer = separation_forces(pos, vel, separation, maxspeed, maxforce)
+        for v, force in zip(vehicles, steer.tolist()):
+            v.acc += force
 
     def events(self):
         # game loop events
         for event in pg.event.get():
             if event.type == pg.QUIT:
                 self.running = False
+            elif event.type == pg.MOUSEMOTION:
+                self.mouse = vec(event.pos)
             elif event.type == pg.MOUSEBUTTONUP:
                 if event.button == 1:
                     # left mouse click
                     pos = vec(pg.mouse.get_pos())
                     self.path.append(pos)
+                    self.path_index.add_point(pos)
+                    if self.mode == 'goal':
+                        self.flowfield.set_goal(pos)
+                elif event.button == 2 and self.mode == 'goal':
+                    # middle mouse click places or removes an obstacle
+                    self.flowfield.toggle_obstacle(vec(pg.mouse.get_pos()))
                 elif event.button == 3:
                     # right mouse click resets the path
                     self.path = []
+                    self.path_index = PathIndex()
                     for v in self.vehicles:
                         v.target_index = 0
             elif event.type == pg.KEYDOWN:
                 if event.key == pg.K_r:
                     self.show_field = not self.show_field
+                    self.field_version = None
+                elif event.key == pg.K_n:
+                    self.noise_field = not self.noise_field
 
     def draw(self):
         self.screen.fill(BG_COLOR)
@@ -121,11 +336,15 @@ class Game:
         if self.mode == 'follow':
             if self.show_field:
                 self.draw_field()
+        if self.mode == 'goal':
+            # the obstacles and the goal are part of the field overlay
+            self.draw_field()
         if self.mode == 'path':
             self.draw_path()
 
-        self.all_sprites.draw(self.screen)
-        pg.display.flip()
+        self.renderer.draw(self.screen)
+        if not self.headless:
+            pg.display.flip()
 
     def draw_vectors(self):
         """
@@ -145,18 +364,37 @@ class Game:
 
     def draw_field(self):
         """
-        Draws the flow field vectors
+        Draws the flow field vectors. They are rendered onto an off-screen
+        surface (including the background) that is only redrawn when the
+        field has changed
         """
+        if self.field_version != self.flowfield.version:
+            self.render_field(self.field_surface)
+            self.field_version = self.flowfield.version
+        self.screen.blit(self.field_surface, (0, 0))
+
+    def render_field(self, surface):
         field = self.flowfield.field
-        w = len(field)
-        h = len(field[0])
-        for i in range(h):
-            for j in range(w):
-                start = vec(WIDTH / w * j + (WIDTH / w) / 2,
-                            HEIGHT / h * i + (HEIGHT / h) / 2)
-                end1 = start + field[j][i] * self.flowfield.resolution / 2.5
-                end2 = start - field[j][i] * self.flowfield.resolution / 2.5
-                pg.draw.line(self.screen, FLOWFIELD_COLOR, end1, end2, 2)
+        res = self.flowfield.resolution
+        # the centers of all cells and both ends of their lines
+        rows, cols = np.mgrid[0:self.flowfield.rows, 0:self.flowfield.cols]
+        start = np.stack((cols, rows), axis=-1) * res + res / 2
+        offset = field * res / 2.5
+        ends = np.concatenate((start + offset, start - offset), axis=-1)
+
+        surface.fill(BG_COLOR)
+        integration = self.flowfield.integration
+        for row, col in zip(*np.nonzero(integration.blocked())):
+            pg.draw.rect(surface, OBSTACLE_COLOR,
+                         (col * res, row * res, res, res))
+        if self.show_field:
+            for x1, y1, x2, y2 in ends.reshape(-1, 4).tolist():
+                pg.draw.line(surface, FLOWFIELD_COLOR, (x1, y1), (x2, y2), 2)
+        if integration.goal is not None:
+            row, col = divmod(integration.goal, self.flowfield.cols)
+            pg.draw.circle(surface, GOAL_COLOR, (int(start[row, col, 0]),
+                                                 int(start[row, col, 1])),
+                           res // 4)
 
     def draw_path(self):
         """Draws the path for the boids to follow"""
@@ -164,81 +402,678 @@ class Game:
             for i in range(1, len(self.path)):
                 pg.draw.line(self.screen, (0, 150, 0),
                              self.path[i - 1], self.path[i], 1)
+            # the path is a closed loop
+            pg.draw.line(self.screen, (0, 150, 0),
+                         self.path[-1], self.path[0], 1)
         elif len(self.path) == 1:
             pg.draw.circle(self.screen, (0, 150, 0),
                            (int(self.path[0].x), int(self.path[0].y)), 1)
 
 
+class RotationCache:
+    """
+    An image pre-rendered at every multiple of step degrees, shared by all
+    vehicles that look the same
+    """
+    def __init__(self, image, step=ROTATION_STEP):
+        self.step = step
+        self.images = [pg.transform.rotate(image, i * step)
+                       for i in range(round(360 / step))]
+
+    def get(self, angle):
+        # returns the cached image closest to the given angle
+        return self.images[round(angle / self.step) % len(self.images)]
+
+    def memory(self):
+        # size of all cached images in bytes
+        return sum(img.get_bytesize() * img.get_width() * img.get_height()
+                   for img in self.images)
+
+
+class PerlinNoise:
+    """
+    2d gradient noise (the same algorithm as noise.pnoise2) that evaluates
+    whole arrays of points in one NumPy pass
+    """
+    def __init__(self, seed=0):
+        perm = np.random.RandomState(seed).permutation(256)
+        # doubled so that no index has to be wrapped
+        self.perm = np.concatenate((perm, perm))
+
+    def noise2(self, x, y):
+        x, y = np.broadcast_arrays(np.asarray(x, dtype=float),
+                                   np.asarray(y, dtype=float))
+        xi = np.floor(x).astype(int)
+        yi = np.floor(y).astype(int)
+        # position inside the unit square and its fade curves
+        xf = x - xi
+        yf = y - yi
+        u = xf * xf * xf * (xf * (xf * 6 - 15) + 10)
+        v = yf * yf * yf * (yf * (yf * 6 - 15) + 10)
+        xi &= 255
+        yi &= 255
+        # hash the four corners of the square
+        p = self.perm
+        a = p[xi] + yi
+        b = p[xi + 1] + yi
+        n00 = self.grad(p[a], xf, yf)
+        n10 = self.grad(p[b], xf - 1, yf)
+        n01 = self.grad(p[a + 1], xf, yf - 1)
+        n11 = self.grad(p[b + 1], xf - 1, yf - 1)
+        # blend the corner contributions
+        n0 = n00 + u * (n10 - n00)
+        n1 = n01 + u * (n11 - n01)
+        return n0 + v * (n1 - n0)
+
+    def grad(self, h, x, y):
+        g = GRAD2[h & 15]
+        return g[..., 0] * x + g[..., 1] * y
+
+
+class IntegrationField:
+    """
+    Integration field for goal-directed flow fields: Dijkstra's algorithm
+    over a grid of cell costs gives the length of the cheapest route from
+    every cell to the goal. Cells are indexed row * cols + column, blocked
+    cells have an infinite cost
+    """
+    def __init__(self, rows, cols):
+        self.rows = rows
+        self.cols = cols
+        self.cost = [1.0] * (rows * cols)
+        self.dist = [math.inf] * (rows * cols)
+        # the next cell on the route to the goal, -1 if there is none
+        self.parent = [-1] * (rows * cols)
+        self.goal = None
+
+    def adjacent(self, i):
+        # yields the neighbours of cell i and the length of the step to them
+        row, col = divmod(i, self.cols)
+        for dr, dc, step in NEIGHBORS:
+            r = row + dr
+            c = col + dc
+            if 0 <= r < self.rows and 0 <= c < self.cols:
+                yield r * self.cols + c, step
+
+    def passable(self, i):
+        # yields the neighbours that can be walked to from cell i, without
+        # cutting the corner of a blocked cell on diagonal steps
+        cost = self.cost
+        row, col = divmod(i, self.cols)
+        for j, step in self.adjacent(i):
+            if cost[j] == math.inf:
+                continue
+            r, c = divmod(j, self.cols)
+            if (r != row and c != col and
+                    (cost[row * self.cols + c] == math.inf or
+                     cost[r * self.cols + col] == math.inf)):
+                continue
+            yield j, step
+
+    def set_goal(self, goal):
+        # rebuilds the whole field for a new goal cell
+        self.goal = goal
+        n = self.rows * self.cols
+        self.dist = [math.inf] * n
+        self.parent = [-1] * n
+        if self.cost[goal] < math.inf:
+            self.dist[goal] = 0
+            self.search([(0, goal)])
+
+    def update_costs(self, changes):
+        """
+        Changes the cost of some cells ({cell: cost}) and repairs only the
+        part of the field whose routes ran through them
+        """
+        parent = self.parent
+        cols = self.cols
+        seeds = []
+        for i, cost in changes.items():
+            self.cost[i] = cost
+            seeds.append(i)
+            # diagonal steps past a changed cell may be (un)blocked now
+            for j, step in self.adjacent(i):
+                if parent[j] >= 0 and parent[j] % cols != j % cols and (
+                        parent[j] // cols != j // cols):
+                    seeds.append(j)
+        if self.goal is None:
+            return
+
+        # invalidate the seeds and every cell whose route runs through them
+        invalid = set()
+        while seeds:
+            i = seeds.pop()
+            if i not in invalid:
+                invalid.add(i)
+                seeds.extend(j for j, step in self.adjacent(i)
+                             if parent[j] == i)
+        for i in invalid:
+            self.dist[i] = math.inf
+            parent[i] = -1
+
+        # continue the search from the valid cells around the invalid ones
+        heap = []
+        if self.goal in invalid and self.cost[self.goal] < math.inf:
+            self.dist[self.goal] = 0
+            heap.append((0, self.goal))
+        for i in invalid:
+            for j, step in self.passable(i):
+                if j not in invalid:
+                    heap.append((self.dist[j], j))
+        heapify(heap)
+        self.search(heap)
+
+    def search(self, heap):
+        # Dijkstra's algorithm from the cells on the heap outwards
+        dist = self.dist
+        cost = self.cost
+        while heap:
+            d, i = heappop(heap)
+            if d > dist[i]:
+                continue
+            for j, step in self.passable(i):
+                new_dist = d + step * (cost[i] + cost[j]) / 2
+                if new_dist < dist[j]:
+                    dist[j] = new_dist
+                    self.parent[j] = i
+                    heappush(heap, (new_dist, j))
+
+    def blocked(self):
+        return np.array(self.cost).reshape(self.rows, self.cols) == math.inf
+
+    def gradient(self):
+        """
+        Returns a (rows, cols, 2) array of unit vectors that point from each
+        cell to its neighbour closest to the goal (zero at the goal and in
+        cells that can't reach it)
+        """
+        dist = np.array(self.dist).reshape(self.rows, self.cols)
+        blocked = np.pad(self.blocked(), 1, constant_values=True)
+        padded = np.pad(dist, 1, constant_values=math.inf)
+        neighbor_dist = []
+        for dr, dc, step in NEIGHBORS:
+            d = padded[1 + dr:1 + dr + self.rows, 1 + dc:1 + dc + self.cols]
+            if dr and dc:
+                # no cutting corners
+                corner = (blocked[1 + dr:1 + dr + self.rows, 1:-1] |
+                          blocked[1:-1, 1 + dc:1 + dc + self.cols])
+                d = np.where(corner, math.inf, d)
+            neighbor_dist.append(d)
+        neighbor_dist = np.stack(neighbor_dist, axis=-1)
+        best = np.argmin(neighbor_dist, axis=-1)
+        directions = np.array([(dc, dr) for dr, dc, step in NEIGHBORS],
+                              dtype=float)
+        directions /= np.linalg.norm(directions, axis=1, keepdims=True)
+        gradient = directions[best]
+        downhill = np.take_along_axis(neighbor_dist, best[..., None],
+                                      axis=-1)[..., 0] < dist
+        gradient[~downhill] = 0
+        return gradient
+
+
 class FlowField:
-    def __init__(self, resolution):
+    """
+    A grid of direction vectors. New fields are computed into a back
+    buffer (on a background thread unless background is False) while the
+    vehicles read the front buffer, which is swapped at a frame boundary
+    and optionally blended over blend_frames frames
+    """
+    def __init__(self, resolution, background=True, blend_frames=0,
+                 seed=None):
         self.resolution = resolution
         self.cols = WIDTH // self.resolution
         self.rows = HEIGHT // self.resolution
-        self.field = [[None for i in range(self.cols)]
-                      for j in range(self.rows)]
+        # one direction vector per cell, stored as a (rows, cols, 2) array.
+        # The arrays are never changed in place, only replaced.
+        # self.field is a view into self.padded, a contiguous copy with a
+        # border of one cell repeating the edges, see sample_many()
+        self.padded = None
+        self.field = None
+        self.set_front(np.zeros((self.rows, self.cols, 2)))
+        # the newest complete field (differs from field while blending)
+        self.target = self.field
 
         self.timer = 0
-        self.dir = vec(1, 1)
-
-        for i in range(self.rows):
-            for j in range(self.cols):
-                self.field[i][j] = vec()
+        self.dir = np.array([1.0, 1.0])
+        # increased whenever the field changes
+        self.version = 0
+        # for goal-directed fields, see set_goal()
+        self.integration = IntegrationField(self.rows, self.cols)
+
+        # (key, future) of the field being computed in the back buffer
+        self.pending = None
+        self.worker = None
+        if background:
+            self.worker = ThreadPoolExecutor(max_workers=1)
+        # only used by the worker
+        self.rng = np.random.default_rng(seed)
+        self.blend_frames = blend_frames
+        self.blend_from = None
+        self.blend_step = 0
 
         self.z_off = random()  # z offset for perlin noise
+        self.z_start = self.z_off
+        self.z_step = 0
+        # z step the field was last built for by change_noise()
+        self.noise_step = None
+        self.noise = PerlinNoise()
+        # optional precomputed fields over z, see bake_noise()
+        self.noise_volume = None
 
     def lookup(self, vector):
         column = int(constrain(vector.x / self.resolution, 0, self.cols - 1))
         row = int(constrain(vector.y / self.resolution, 0, self.rows - 1))
-        return vec(self.field[row][column])
+        return vec(*self.field[row, column])
+
+    def cell(self, vector):
+        # index of the cell at the given position in the integration field
+        column = int(constrain(vector.x / self.resolution, 0, self.cols - 1))
+        row = int(constrain(vector.y / self.resolution, 0, self.rows - 1))
+        return row * self.cols + column
+
+    def set_goal(self, vector):
+        """
+        Turns this into a goal-directed field that leads around the
+        obstacles to the given position
+        """
+        goal = self.cell(vector)
+        if goal != self.integration.goal:
+            self.integration.set_goal(goal)
+            self.apply_integration()
+
+    def toggle_obstacle(self, vector):
+        i = self.cell(vector)
+        if self.integration.cost[i] == math.inf:
+            cost = 1.0
+        else:
+            cost = math.inf
+        self.integration.update_costs({i: cost})
+        self.apply_integration()
+
+    def apply_integration(self):
+        # the field points along the gradient of the integration field
+        self.show(self.integration.gradient())
+
+    def lookup_many(self, positions):
+        """
+        Looks up the field vectors for an array of (x, y) positions at once
+        and returns them as a (n, 2) array
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        columns = np.clip(positions[:, 0] // self.resolution,
+                          0, self.cols - 1).astype(int)
+        rows = np.clip(positions[:, 1] // self.resolution,
+                       0, self.rows - 1).astype(int)
+        return self.field[rows, columns]
+
+    def sample_many(self, positions):
+        """
+        Bilinearly interpolates the field between the cell centers for an
+        array of (x, y) positions and returns the normalized directions as
+        a (n, 2) array. Thanks to the padding, the four cells around a
+        position never need their own bounds checks
+        """
+        positions = np.asarray(positions, dtype=float).reshape(-1, 2)
+        # coordinates in the padded grid, where the center of padded cell
+        # (i, j) is at (i, j), so the center of field cell (0, 0) is at
+        # (1, 1) and x0, y0 are the cells up and left of the position
+        x = np.clip(positions[:, 0] / self.resolution + 0.5,
+                    0, self.cols + 0.999)
+        y = np.clip(positions[:, 1] / self.resolution + 0.5,
+                    0, self.rows + 0.999)
+        x0 = x.astype(int)
+        y0 = y.astype(int)
+        tx = (x - x0)[:, None]
+        ty = (y - y0)[:, None]
+        # the four surrounding cells in the flattened padded grid
+        width = self.cols + 2
+        flat = self.padded.reshape(-1, 2)
+        i = y0 * width + x0
+        top = flat[i] * (1 - tx) + flat[i + 1] * tx
+        bottom = flat[i + width] * (1 - tx) + flat[i + width + 1] * tx
+        sample = top * (1 - ty) + bottom * ty
+        length = np.hypot(sample[:, 0], sample[:, 1])[:, None]
+        return np.divide(sample, length, out=np.zeros_like(sample),
+                         where=length > 0)
+
+    # ----- double buffering -----
+
+    def submit(self, key, function, *args):
+        # starts computing the back buffer, unless that is already happening
+        if self.pending is not None and self.pending[0] == key:
+            return
+        if self.worker is not None:
+            future = self.worker.submit(function, *args)
+        else:
+            future = Future()
+            future.set_result(function(*args))
+        self.pending = (key, future)
+
+    def result(self, key):
+        # returns the back buffer if it is done, otherwise None
+        if self.pending is None or self.pending[0] != key:
+            return None
+        if not self.pending[1].done():
+            return None
+        result = self.pending[1].result()
+        self.pending = None
+        return result
+
+    def show(self, field):
+        # swaps a new field to the front
+        self.target = field
+        if self.blend_frames > 0:
+            self.blend_from = self.field
+            self.blend_step = 0
+            self.blend()
+        else:
+            self.set_front(field)
+            self.version += 1
+
+    def set_front(self, field):
+        self.padded = np.pad(field, ((1, 1), (1, 1), (0, 0)), mode='edge')
+        self.field = self.padded[1:-1, 1:-1]
+
+    def blend(self):
+        # moves the front buffer one frame further towards the new field
+        if self.blend_from is None:
+            return
+        self.blend_step += 1
+        if self.blend_step >= self.blend_frames:
+            self.set_front(self.target)
+            self.blend_from = None
+        else:
+            t = self.blend_step / self.blend_frames
+            field = self.blend_from * (1 - t) + self.target * t
+            length = np.linalg.norm(field, axis=2, keepdims=True)
+            self.set_front(np.divide(field, length, out=np.zeros_like(field),
+                                     where=length > 0))
+        self.version += 1
+
+    def close(self):
+        if self.worker is not None:
+            self.worker.shutdown(wait=False, cancel_futures=True)
+
+    # ----- field updates -----
 
     def change(self):
         self.timer += 1
+        self.blend()
         if self.timer > randrange(10, 20):
-            for i in range(self.rows):
-                for j in range(self.cols):
-                    change = 0.8
-                    # change the angle by a small random amount
-                    self.field[i][j] += (vec(uniform(-change, change),
-                                             uniform(-change,
-                                                     change)) + self.dir)
-                    self.field[i][j] = self.field[i][j].normalize()
-
-            # change the general direction
-            change2 = 0.5
-
-            self.dir.x += uniform(-change2, change2)
-            self.dir.y += uniform(-change2, change2)
-            self.dir = self.dir.normalize()
-            self.timer = 0
+            result = self.result('random')
+            if result is not None:
+                field, self.dir = result
+                self.show(field)
+                self.timer = 0
+        # prepare the next field while this one is shown
+        self.submit('random', self.random_field, self.target, self.dir)
+
+    def random_field(self, field, direction):
+        """
+        Returns the next field with the angles changed by a small random
+        amount, and the new general direction
+        """
+        change = 0.8
+        field = field + self.rng.uniform(-change, change, field.shape)
+        field += direction
+        field /= np.linalg.norm(field, axis=2, keepdims=True)
+
+        # change the general direction
+        change2 = 0.5
+
+        direction = direction + self.rng.uniform(-change2, change2, 2)
+        direction /= np.linalg.norm(direction)
+        return field, direction
 
     def change_noise(self):
         self.timer += 1
+        self.blend()
 
         if self.timer > 2:
-            self.z_off += 0.02
+            self.z_step += 1
+            self.z_off = self.z_start + self.z_step * 0.02
             self.timer = 0
 
-        x_off = self.z_off
-        for i in range(self.rows):
-            y_off = self.z_off
-            for j in range(self.cols):
-                n = noise.pnoise2(x_off, y_off)
-                theta = remap(n, -1, 1, 0, math.pi * 2)
-                self.field[i][j] = vec(math.cos(theta), math.sin(theta))
-                y_off += 0.1
-            x_off += 0.1
+        if self.noise_volume is not None:
+            if self.z_step != self.noise_step:
+                # the field only changes when z moves on
+                self.show(self.noise_volume[self.z_step %
+                                            len(self.noise_volume)])
+                self.noise_step = self.z_step
+            return
+
+        if self.pending is None or self.pending[0][0] != 'noise':
+            self.prefetch_noise()
+        # show the back buffer once z has reached it (if the worker fell
+        # behind, this is a field from an earlier z step)
+        key = self.pending[0]
+        if key[1] <= self.z_step:
+            field = self.result(key)
+            if field is not None:
+                self.show(field)
+                self.noise_step = key[1]
+                self.prefetch_noise()
+
+    def prefetch_noise(self):
+        # computes the field for the next z step while this one is shown
+        step = self.z_step
+        if self.noise_step is not None:
+            step += 1
+        self.submit(('noise', step), self.noise_field,
+                    self.z_start + step * 0.02)
+
+    def noise_field(self, z_off):
+        """
+        Builds the field for one or more z offsets in a single pass,
+        returns an array of shape z_off.shape + (rows, cols, 2)
+        """
+        z = np.asarray(z_off, dtype=float)[..., None, None]
+        x_off = z + np.arange(self.rows)[:, None] * 0.1
+        y_off = z + np.arange(self.cols)[None, :] * 0.1
+        n = self.noise.noise2(x_off, y_off)
+        # same mapping as remap(n, -1, 1, 0, 2 * pi)
+        theta = np.clip((n + 1) * math.pi, 0, math.pi * 2)
+        return np.stack((np.cos(theta), np.sin(theta)), axis=-1)
+
+    def bake_noise(self, frames):
+        """
+        Precomputes the noise field for the next frames z steps, so that
+        change_noise() only has to pick a slice. The animation loops
+        after the last frame
+        """
+        z = self.z_start + np.arange(frames) * 0.02
+        self.noise_volume = self.noise_field(z)
+        self.noise_step = None
+
+
+class Renderer:
+    """
+    Draws sprites in layers, each layer with one Surface.blits call.
+    Anything with its own draw(surface) method (like the ParticleSystem)
+    can be added to a layer as well. Vehicles are never removed, so
+    layers are only emptied all at once by clear(). Drawing is bound by
+    the blits, so this takes about as long as LayeredUpdates did
+    """
+    def __init__(self):
+        # layer numbers in drawing order
+        self.layers = []
+        # layer -> sprites in the order they were added
+        self.buckets = {}
+        # layer -> objects that draw themselves
+        self.batches = {}
+
+    def add(self, item, layer):
+        if layer not in self.buckets:
+            insort(self.layers, layer)
+            self.buckets[layer] = []
+            self.batches[layer] = []
+        if isinstance(item, pg.sprite.Sprite):
+            self.buckets[layer].append(item)
+        else:
+            self.batches[layer].append(item)
+
+    def clear(self):
+        self.layers = []
+        self.buckets = {}
+        self.batches = {}
+
+    def draw(self, surface):
+        image_and_rect = attrgetter('image', 'rect')
+        for layer in self.layers:
+            for batch in self.batches[layer]:
+                batch.draw(surface)
+            surface.blits(map(image_and_rect, self.buckets[layer]),
+                          doreturn=False)
+
+
+class PathIndex:
+    """
+    A closed path (the last point connects back to the first one) with a
+    uniform grid over its segments, for finding the closest point on the
+    path without testing every segment. Segment k runs from point k to
+    point k + 1
+    """
+    def __init__(self, cell_size=50):
+        self.cell_size = cell_size
+        self.points = []
+        # (column, row) -> indices of the segments that pass the cell
+        self.cells = {}
+        self.min_cell = None
+        self.max_cell = None
+        # length of the segments without the closing one
+        self.open_length = 0
+
+    def add_point(self, point):
+        self.points.append((point[0], point[1]))
+        if len(self.points) > 1:
+            self.add_segment(len(self.points) - 2)
+            (x1, y1), (x2, y2) = self.points[-2:]
+            self.open_length += math.hypot(x2 - x1, y2 - y1)
+
+    def length(self):
+        # total length of the closed path
+        if len(self.points) < 2:
+            return 0
+        (x1, y1), (x2, y2) = self.points[-1], self.points[0]
+        return self.open_length + math.hypot(x2 - x1, y2 - y1)
+
+    def add_segment(self, k):
+        # adds segment k to every cell its bounding box overlaps
+        (x1, y1), (x2, y2) = self.points[k], self.points[k + 1]
+        c1, r1 = self.cell(min(x1, x2), min(y1, y2))
+        c2, r2 = self.cell(max(x1, x2), max(y1, y2))
+        for col in range(c1, c2 + 1):
+            for row in range(r1, r2 + 1):
+                self.cells.setdefault((col, row), []).append(k)
+        if self.min_cell is None:
+            self.min_cell = (c1, r1)
+            self.max_cell = (c2, r2)
+        else:
+            self.min_cell = (min(self.min_cell[0], c1),
+                             min(self.min_cell[1], r1))
+            self.max_cell = (max(self.max_cell[0], c2),
+                             max(self.max_cell[1], r2))
+
+    def cell(self, x, y):
+        return int(x // self.cell_size), int(y // self.cell_size)
+
+    def segment(self, k):
+        return self.points[k], self.points[(k + 1) % len(self.points)]
+
+    def project(self, x, y, k):
+        # closest point to (x, y) on segment k and its squared distance
+        (x1, y1), (x2, y2) = self.segment(k)
+        dx = x2 - x1
+        dy = y2 - y1
+        length_sq = dx * dx + dy * dy
+        if length_sq == 0:
+            t = 0
+        else:
+            t = constrain(((x - x1) * dx + (y - y1) * dy) / length_sq, 0, 1)
+        px = x1 + dx * t
+        py = y1 + dy * t
+        return (px - x) ** 2 + (py - y) ** 2, px, py
+
+    def nearest(self, point):
+        """
+        Returns the closest point on the path to the given point and the
+        index of its segment. Searches the grid in growing rings around the
+        point and stops once no unseen segment can be any closer
+        """
+        x, y = point
+        # the closing segment isn't in the grid
+        k = len(self.points) - 1
+        best = self.project(x, y, k) + (k,)
+        if len(self.points) <= 16:
+            # short paths are quicker to test segment by segment
+            for k in range(len(self.points) - 1):
+                candidate = self.project(x, y, k)
+                if candidate[0] < best[0]:
+                    best = candidate + (k,)
+        elif self.min_cell is not None:
+            col, row = self.cell(x, y)
+            max_r = max(col - self.min_cell[0], self.max_cell[0] - col,
+                        row - self.min_cell[1], self.max_cell[1] - row)
+            seen = set()
+            r = 0
+            # after the rings up to r - 1, every unseen segment is at least
+            # (r - 1) * cell_size away
+            while (r <= max_r and
+                   best[0] > (max(r - 1, 0) * self.cell_size) ** 2):
+                for c, rr in self.ring(col, row, r):
+                    for k in self.cells.get((c, rr), ()):
+                        if k not in seen:
+                            seen.add(k)
+                            candidate = self.project(x, y, k)
+                            if candidate[0] < best[0]:
+                                best = candidate + (k,)
+                r += 1
+        return vec(best[1], best[2]), best[3]
+
+    def ring(self, col, row, r):
+        # the cells at distance r around (col, row), within the grid bounds
+        if r == 0:
+            return [(col, row)]
+        (min_c, min_r), (max_c, max_r) = self.min_cell, self.max_cell
+        columns = range(max(col - r, min_c), min(col + r, max_c) + 1)
+        rows = range(max(row - r + 1, min_r), min(row + r - 1, max_r) + 1)
+        cells = []
+        for rr in (row - r, row + r):
+            if min_r <= rr <= max_r:
+                cells.extend((c, rr) for c in columns)
+        for c in (col - r, col + r):
+            if min_c <= c <= max_c:
+                cells.extend((c, rr) for rr in rows)
+        return cells
+
+    def ahead(self, point, k, distance):
+        # walks the given distance along the path from a point on segment k
+        x, y = point
+        if self.length() == 0:
+            # all points are the same, there is nowhere to walk
+            return vec(x, y)
+        while True:
+            (x1, y1), (x2, y2) = self.segment(k)
+            left = math.hypot(x2 - x, y2 - y)
+            if left >= distance or len(self.points) < 2:
+                break
+            distance -= left
+            x, y = x2, y2
+            k = (k + 1) % len(self.points)
+        if left == 0:
+            return vec(x, y)
+        return vec(x + (x2 - x) / left * distance,
+                   y + (y2 - y) / left * distance)
+
 
 # ------ SPRITES --------------------------------------------------------------
 
 
 class Vehicle(pg.sprite.Sprite):
     def __init__(self, game, size, pos):
-        groups = game.all_sprites, game.vehicles
-        self._layer = size[0]
-        super().__init__(groups)
-
-        # for g in self.groups:
-        #     g.add(self, layer=self.layer)
+        super().__init__(game.vehicles)
+        # bigger vehicles are drawn on top
+        game.renderer.add(self, size[0])
         self.game = game
         self.size = size
         self.pos = vec(pos)
@@ -246,6 +1081,8 @@ class Vehicle(pg.sprite.Sprite):
         self.acc = vec(0, 0)
         self.steer = vec(0, 0)
         self.desired = vec(0, 0)
+        # flow field direction under this vehicle, set by the game each frame
+        self.flow = vec(0, 0)
         self.extent = vec(0, 0)
         self.target = vec(0, 0)
 
@@ -268,20 +1105,38 @@ class Vehicle(pg.sprite.Sprite):
                                                  self.rect.midtop,
                                                  self.rect.bottomright))
         self.normal_image = self.image
+        key = (self.size, self.color)
+        if key not in game.rotation_caches:
+            game.rotation_caches[key] = RotationCache(self.normal_image)
+        self.rotations = game.rotation_caches[key]
         self.points_visited = []
         self.target_index = 0
 
     def update(self):
+        self.steer_mode()
+        self.move()
+        self.rotate()
+        # create some particles for visual appeal
+        self.emit_particle()
+
+    def steer_mode(self):
+        # applies the steering behaviour of the current game mode
         self.clock += 1
-        if MODE == 'wander':
+        mode = self.game.mode
+        if mode == 'wander':
             self.wander()
-        elif MODE == 'follow':
+        elif mode in ('follow', 'goal'):
             self.follow()
-        elif MODE == 'arrive':
-            self.arrive(vec(pg.mouse.get_pos()))
-        elif MODE == 'path' and len(self.game.path) >= 1:
+        elif mode == 'arrive':
+            self.arrive(self.game.mouse)
+        elif mode == 'path' and (len(self.game.path) == 1 or
+                                 self.game.path_index.length() == 0):
+            # a path without length can't be followed
             self.seek_points()
+        elif mode == 'path' and len(self.game.path) > 1:
+            self.follow_path()
 
+    def move(self):
         self.vel += self.acc
         limit(self.vel, self.maxspeed)  # TODO: incorporate friction!
         self.pos += self.vel
@@ -297,16 +1152,13 @@ class Vehicle(pg.sprite.Sprite):
         elif self.pos.y > HEIGHT:
             self.pos.y = 0
 
+    def rotate(self):
         # rotate image in the direction of velocity
-        angle = self.vel.angle_to(vec(0, -1))
-        self.image = pg.transform.rotate(self.normal_image, angle)
-        self.rect = self.image.get_rect()
-
+        angle = self.vel.angle_to(UP)
+        self.image = self.rotations.get(angle)
+        self.rect.size = self.image.get_size()
         self.rect.center = self.pos
 
-        # create some particles for visual appeal
-        self.emit_particle()
-
     def wander(self):
         self.arrive(self.target)
 
@@ -343,6 +1195,19 @@ class Vehicle(pg.sprite.Sprite):
             if self.target_index == len(self.game.path):
                 self.target_index = 0
 
+    def follow_path(self):
+        # predict where this vehicle will be a little ahead
+        predict = self.pos + self.vel
+        if self.vel.length_squared() != 0:
+            predict = self.pos + self.vel.normalize() * PATH_LOOKAHEAD
+        # closest point on the path and a target a bit further along it
+        normal, k = self.game.path_index.nearest(predict)
+        target = self.game.path_index.ahead(normal, k, PATH_LOOKAHEAD)
+        # only steer when drifting off the path (or too slow to get going)
+        if (predict.distance_to(normal) > PATH_RADIUS or
+                self.vel.length() < self.maxspeed / 2):
+            self.seek(target)
+
     def arrive(self, target):
         # get vector from self to target
         self.desired = target - self.pos
@@ -365,8 +1230,7 @@ class Vehicle(pg.sprite.Sprite):
         self.acc += self.steer
 
     def follow(self):
-        desired = self.game.flowfield.lookup(self.pos)
-        desired *= self.maxspeed
+        desired = self.flow * self.maxspeed
 
         steer = desired - self.vel
         limit(steer, self.maxforce)
@@ -397,38 +1261,120 @@ class Vehicle(pg.sprite.Sprite):
     def emit_particle(self):
         if self.clock >= self.particle_interval:
             self.clock = 0
-            Particle(self.game, self.pos, self.size[0] / 3,
-                     self.particle_vanishing_rate)
-
-
-class Particle(pg.sprite.Sprite):
-    def __init__(self, game, pos, diameter, vanishing_rate):
-        self.groups = game.all_sprites
-        pg.sprite.Sprite.__init__(self)
-        self.layer = -1
-        self.groups.add(self, layer=self.layer)
-        self.game = game
-        self.pos = vec(pos)
-
-        self.image = pg.Surface((diameter, diameter))
-        self.image.fill((0, 0, 0))
-        self.image.set_colorkey((0, 0, 0))
-        self.rect = self.image.get_rect()
-
-        pg.draw.ellipse(self.image, (255, 100, 0), self.rect)
-        self.alpha = 255
-        self.vanishing_rate = vanishing_rate
-
-        self.rect.center = self.pos
+            self.game.particles.emit(self.pos, self.size[0] / 3,
+                                     self.particle_vanishing_rate)
+
+
+class ParticleSystem:
+    """
+    A fixed-size pool of fading particles. The particles are stored in
+    arrays, share pre-rendered images and are drawn with one blits call.
+    When the pool is full, the oldest particle is replaced
+    """
+    def __init__(self, capacity, color=(255, 100, 0)):
+        self.capacity = capacity
+        self.color = color
+        # top left corner of each particle's image
+        self.pos = np.zeros((capacity, 2), dtype=int)
+        self.diameter = np.zeros(capacity, dtype=int)
+        # a particle is alive while its alpha is above 0
+        self.alpha = np.zeros(capacity, dtype=int)
+        self.vanishing_rate = np.zeros(capacity, dtype=int)
+        # slot for the next particle (the oldest one once the pool is full)
+        self.next = 0
+        # shared images, keyed by diameter * 256 + alpha
+        self.images = {}
+
+    def emit(self, pos, diameter, vanishing_rate):
+        i = self.next
+        d = int(diameter)
+        self.pos[i] = (round(pos[0]) - d // 2, round(pos[1]) - d // 2)
+        self.diameter[i] = d
+        self.alpha[i] = 255
+        self.vanishing_rate[i] = vanishing_rate
+        self.next = (i + 1) % self.capacity
 
     def update(self):
-        self.rect.center = self.pos
-
-        self.image.set_alpha(self.alpha)
-
-        self.alpha -= self.vanishing_rate
-        if self.alpha <= 0:
-            self.kill()
+        alive = self.alpha > 0
+        self.alpha[alive] -= self.vanishing_rate[alive]
+
+    def render(self, diameter, alpha):
+        image = pg.Surface((diameter, diameter))
+        image.fill((0, 0, 0))
+        # the images never change, so they can be run-length encoded
+        image.set_colorkey((0, 0, 0), pg.RLEACCEL)
+        pg.draw.ellipse(image, self.color, image.get_rect())
+        image.set_alpha(alpha, pg.RLEACCEL)
+        return image
+
+    def draw(self, surface):
+        # alive particles, oldest first
+        alive = np.flatnonzero(np.roll(self.alpha > 0, -self.next))
+        alive = (alive + self.next) % self.capacity
+        # a particle is drawn with the alpha it had before its last update
+        shown = np.minimum(self.alpha[alive] + self.vanishing_rate[alive],
+                           255)
+        keys = self.diameter[alive] * 256 + shown
+        for key in np.unique(keys).tolist():
+            if key not in self.images:
+                self.images[key] = self.render(key // 256, key % 256)
+        surface.blits(zip(map(self.images.get, keys.tolist()),
+                          self.pos[alive].tolist()), doreturn=False)
+
+
+# ------ BENCHMARK ------------------------------------------------------------
+
+def benchmark(modes=MODES, num_boids=40, steps=300, seed=0, draw=False,
+              background=False, outfile='steering_benchmark.json'):
+    """
+    Runs each mode headless for a fixed number of steps and writes the
+    time spent per phase to a json file. Everything random is seeded, and
+    the flow field is computed inline unless background is True, so runs
+    are repeatable
+    """
+    results = {}
+    for mode in modes:
+        rnd.seed(seed)
+        g = Game(headless=True)
+        g.mode = mode
+        g.num_boids = num_boids
+        g.background_field = background
+        g.new(seed)
+        if mode == 'path':
+            for i in range(8):
+                point = vec(randint(0, WIDTH), randint(0, HEIGHT))
+                g.path.append(point)
+                g.path_index.add_point(point)
+        elif mode == 'goal':
+            for i in range(40):
+                g.flowfield.toggle_obstacle(vec(randint(0, WIDTH),
+                                                randint(0, HEIGHT)))
+
+        g.timings = defaultdict(float)
+        start = perf_counter()
+        for i in range(steps):
+            g.update()
+            if draw:
+                with g.phase('draw'):
+                    g.draw()
+        total = perf_counter() - start
+        g.flowfield.close()
+
+        results[mode] = {
+            'total_ms': total * 1000,
+            'ms_per_step': total * 1000 / steps,
+            'phases_ms_per_step': {name: t * 1000 / steps
+                                   for name, t in sorted(g.timings.items())}
+            }
+        print('{:8} {:8.3f} ms/step  '.format(mode, total * 1000 / steps) +
+              '  '.join('{} {:.3f}'.format(name, t) for name, t in
+                        results[mode]['phases_ms_per_step'].items()))
+
+    settings = {'num_boids': num_boids, 'steps': steps, 'seed': seed,
+                'draw': draw, 'background': background}
+    with open(outfile, 'w') as f:
+        json.dump({'settings': settings, 'modes': results}, f, indent=2)
+    return results
 
 
 # ------ MAIN -----------------------------------------------------------------
@@ -436,8 +1382,8 @@ class Particle(pg.sprite.Sprite):
 def run():
     g = Game()
     try:
-        while g.running:
-            g.new()
+        g.new()
+        g.run()
     except Exception:
         traceback.print_exc()
         pg.quit()
@@ -446,4 +1392,21 @@ def run():
 
 
 if __name__ == '__main__':
-    run()
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--benchmark', action='store_true',
+                        help='run the headless benchmark instead')
+    parser.add_argument('--modes', nargs='+', choices=MODES, default=MODES)
+    parser.add_argument('--boids', type=int, default=40)
+    parser.add_argument('--steps', type=int, default=300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--draw', action='store_true',
+                        help='also time drawing to an off-screen surface')
+    parser.add_argument('--background', action='store_true',
+                        help='compute the flow field on a worker thread')
+    parser.add_argument('--out', default='steering_benchmark.json')
+    args = parser.parse_args()
+    if args.benchmark:
+        benchmark(args.modes, args.boids, args.steps, args.seed, args.draw,
+                  args.background, args.out)
+    else:
+        run()